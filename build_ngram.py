@@ -0,0 +1,119 @@
+#! python
+# -*- coding: utf-8 -*-
+# Author: kun
+# @Time: 2019-10-29 20:54
+
+
+import argparse
+import codecs
+import logging
+import math
+from collections import Counter, defaultdict
+
+from core.text import load_text_encoder
+from core.ngram import NgramLM, token_units
+
+
+def encode_sentence(tokenizer, line):
+    ''' <s> (id 0) + token ids + </s>, subword encoder doesn't append </s> itself '''
+    ids = [0] + tokenizer.encode(line.strip("\r\n "))
+    if ids[-1] != tokenizer.eos_idx:
+        ids.append(tokenizer.eos_idx)
+    return ids
+
+
+def count_ngram(sentences, order):
+    ''' Counts of all n-grams (n <= order) of sentences starting w/ <s> (id 0) '''
+    counts = [Counter() for _ in range(order + 1)]
+    for sent in sentences:
+        for i in range(1, len(sent)):
+            for n in range(1, order + 1):
+                if i - n + 1 < 0:
+                    break
+                counts[n][tuple(sent[i - n + 1:i + 1])] += 1
+    return counts
+
+
+def witten_bell(counts, vocab_size):
+    ''' Interpolated Witten-Bell estimates in backoff form, returns {n-gram: (log10 prob, log10 backoff)} '''
+    order = len(counts) - 1
+    # Count & # of distinct following tokens of each history
+    hist_count, hist_type = defaultdict(int), defaultdict(int)
+    for n in range(1, order + 1):
+        for k, c in counts[n].items():
+            hist_count[k[:-1]] += c
+            hist_type[k[:-1]] += 1
+
+    prob = {}
+    # Unigrams interpolated w/ uniform distribution over all tokens but <s>
+    total, n_type = hist_count[()], hist_type[()]
+    for w in range(1, vocab_size):
+        prob[(w,)] = (counts[1][(w,)] + n_type / (vocab_size - 1)) / (total + n_type)
+    for n in range(2, order + 1):
+        for k, c in counts[n].items():
+            h = k[:-1]
+            prob[k] = (c + hist_type[h] * prob[k[1:]]) / (hist_count[h] + hist_type[h])
+
+    arpa = {}
+    for k, p in prob.items():
+        bow = hist_type[k] / (hist_count[k] + hist_type[k]) if hist_type[k] > 0 else 1.0
+        arpa[k] = (math.log10(p), math.log10(bow))
+    # <s> is context only
+    start = (0,)
+    arpa[start] = (-99.0, math.log10(hist_type[start] / (hist_count[start] + hist_type[start])))
+    return arpa
+
+
+def write_arpa(arpa, units, order, arpa_file):
+    with codecs.open(arpa_file, 'w', encoding='utf-8') as f:
+        f.write('\n\\data\\\n')
+        for n in range(1, order + 1):
+            f.write('ngram {}={}\n'.format(n, sum(len(k) == n for k in arpa)))
+        for n in range(1, order + 1):
+            f.write('\n\\{}-grams:\n'.format(n))
+            for k in sorted(k for k in arpa if len(k) == n):
+                logp, bow = arpa[k]
+                f.write('{:.6f}\t{}'.format(logp, ' '.join(units[w] for w in k)))
+                f.write('\t{:.6f}\n'.format(bow) if n < order else '\n')
+        f.write('\n\\end\\\n')
+
+
+def main(args):
+    tokenizer = load_text_encoder(args.mode, args.vocab_file)
+    if args.arpa_file is None:
+        # Build from transcripts (e.g. OFFICIAL_TXT_SRC of LuTextDataset), one sentence per line
+        sentences = []
+        for input_file in args.input_file:
+            with codecs.open(input_file, 'r', encoding='utf-8') as f:
+                sentences += [encode_sentence(tokenizer, line) for line in f if len(line.strip("\r\n ")) > 0]
+        logging.info("Collected {} sentences.".format(len(sentences)))
+        counts = count_ngram(sentences, args.order)
+        arpa = witten_bell(counts, tokenizer.vocab_size)
+        args.arpa_file = args.output_file.rsplit('.', 1)[0] + '.arpa'
+        write_arpa(arpa, token_units(tokenizer), args.order, args.arpa_file)
+        logging.info("ARPA file stored at {}.".format(args.arpa_file))
+
+    # Binary n-gram LM for decoding
+    lm = NgramLM.from_arpa(args.arpa_file, tokenizer)
+    lm.save(args.output_file)
+    logging.info("{}-gram LM w/ {} n-grams stored at {}.".format(lm.order, len(lm) - 1, args.output_file))
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        "Utility script to build the n-gram LM (ARPA + binary `ngram_path`) needed by n-gram LM decoding.")
+    parser.add_argument("--input_file", nargs='+',
+                        help="Transcripts to build the LM from, one sentence per line.")
+    parser.add_argument("--arpa_file", default=None,
+                        help="Convert existing ARPA file instead of building one (units as the text encoder).")
+    parser.add_argument(
+        "--mode", choices=["character", "word", "subword"], required=True)
+    parser.add_argument("--vocab_file", required=True)
+    parser.add_argument("--output_file", required=True, help="Binary LM (.npz), the ARPA file is stored next to it.")
+    parser.add_argument("--order", type=int, default=3)
+
+    args = parser.parse_args()
+    assert (args.input_file is not None) or (args.arpa_file is not None), 'Either --input_file or --arpa_file'
+    main(args)
@@ -9,9 +9,11 @@ import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.distributions.categorical import Categorical
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 from core.util import init_weights, init_gate
 from core.module import VGGExtractor, RNNLayer, ScaleDotAttention, LocationAwareAttention
+from core.tap import record
 
 
 class ASR(nn.Module):
@@ -55,6 +57,11 @@ class ASR(nn.Module):
         self.decoder.set_state(prev_state)
         self.attention.set_mem(prev_attn)
 
+    def select_state(self, index):
+        ''' Keep decoder/attention states of the rows at index (beam search over a batch of hypotheses) '''
+        self.decoder.select_state(index)
+        self.attention.select_mem(index)
+
     def create_msg(self):
         # Messages for user
         msg = []
@@ -72,7 +79,7 @@ class ASR(nn.Module):
         return msg
 
     def forward(self, audio_feature, feature_len, decode_step, tf_rate=0.0, teacher=None,
-                emb_decoder=None, get_dec_state=False):
+                emb_decoder=None, get_dec_state=False, stop_at_eos=False):
         '''
         Arguments
             audio_feature - [BxTxD] Acoustic feature with shape
@@ -84,6 +91,7 @@ class ASR(nn.Module):
                                     At training stage, this ONLY affects self-sampling (output remains the same)
                                     At inference stage, this affects output to become log prob. with distribution fusion
             get_dec_state - [bool]  If true, return decoder state [BxLxD] for other purpose
+            stop_at_eos   - [bool]  Inference only, stop before decode_step once every sample has emitted <eos>
         '''
         # Init
         bs = audio_feature.shape[0]
@@ -92,22 +100,22 @@ class ASR(nn.Module):
 
         # Encode
         encode_feature, encode_len = self.encoder(audio_feature, feature_len)
-        with open("./tensor_out/train_feature.txt", "a") as featurefile:
-            featurefile.write(f"{audio_feature} | {feature_len} | {audio_feature.size()}\n")
-        with open("./tensor_out/train_encoder.txt", "a") as encoderfile:
-            encoderfile.write(f"{encode_feature} | {encode_len} | {encode_feature.size()}\n")
+        record('train_feature', feature=audio_feature, feature_len=feature_len)
+        record('train_encoder', encode_feature=encode_feature, encode_len=encode_len)
         # CTC based decoding
         if self.enable_ctc:
             ctc_output = F.log_softmax(self.ctc_layer(encode_feature), dim=-1)
 
-        # Attention based decoding
-        if self.enable_att:
+        # Attention based decoding (skipped with decode_step = 0, e.g. greedy CTC decoding)
+        if self.enable_att and decode_step > 0:
             # Init (init char = <SOS>, reset all rnn state and cell)
             self.decoder.init_state(bs)
             self.attention.reset_mem()
             last_char = self.pre_embed(torch.zeros(
                 (bs), dtype=torch.long, device=encode_feature.device))
             att_seq, output_seq = [], []
+            if stop_at_eos:
+                finished = torch.zeros((bs), dtype=torch.bool, device=encode_feature.device)
 
             # Preprocess data for teacher forcing
             if teacher is not None:
@@ -118,8 +126,7 @@ class ASR(nn.Module):
                 # Attend (inputs current state of first layer, encoded features)
                 attn, context = self.attention(
                     self.decoder.get_query(), encode_feature, encode_len)
-                with open("./tensor_out/train_attention.txt", "a") as attfile:
-                    attfile.write(f"{attn} | {context} | {attn.size()}\n")
+                record('train_attention', attn=attn, context=context)
                 # Decode (inputs context + embedded last character)
                 decoder_input = torch.cat([last_char, context], dim=-1)
                 cur_char, d_state = self.decoder(decoder_input)
@@ -146,7 +153,8 @@ class ASR(nn.Module):
                         _, cur_char = emb_decoder(
                             d_state, cur_char, return_loss=False)
                     # argmax for inference
-                    last_char = self.pre_embed(torch.argmax(cur_char, dim=-1))
+                    pred_char = torch.argmax(cur_char, dim=-1)
+                    last_char = self.pre_embed(pred_char)
 
                 # save output of each step
                 output_seq.append(cur_char)
@@ -154,6 +162,12 @@ class ASR(nn.Module):
                 if get_dec_state:
                     dec_state.append(d_state)
 
+                # All samples ended with <eos> (index 1)
+                if stop_at_eos and teacher is None:
+                    finished = finished | (pred_char == 1)
+                    if finished.all():
+                        break
+
             att_output = torch.stack(output_seq, dim=1)  # BxTxV
             att_seq = torch.stack(att_seq, dim=2)  # BxNxDtxT
             if get_dec_state:
@@ -220,9 +234,17 @@ class Encoder_Classifier(nn.Module):
 
 
         # Encode
+        return self.head(self.pool(audio_feature, feature_len))
+
+    def pool(self, audio_feature, feature_len):
+        ''' Utterance representation fed to fc: last encoder step of the first sample [D] '''
         encode_feature, encode_len = self.encoder(audio_feature, feature_len)
 #         print(encode_feature.shape)
-        linear_fea = self.fc(encode_feature[0][-1])
+        return encode_feature[0][-1]
+
+    def head(self, pooled):
+        ''' Classifier on top of pool(), can be trained alone on stored encoder output '''
+        linear_fea = self.fc(pooled)
 #         linear_fea = torch.squeeze(linear_fea, 1)
         out = torch.sigmoid(linear_fea)
 
@@ -287,11 +309,18 @@ class Encoder_CDR(nn.Module):
 
 
         # Encode
+        return self.head(self.pool(audio_feature, feature_len))
+
+    def pool(self, audio_feature, feature_len):
+        ''' Utterance representation fed to fc: last encoder step of the first sample [D] '''
         encode_feature, encode_len = self.encoder(audio_feature, feature_len)
 #         print(encode_feature.shape)
-        out = self.fc(encode_feature[0][-1])
-#         linear_fea = torch.squeeze(linear_fea, 1)
+        return encode_feature[0][-1]
 
+    def head(self, pooled):
+        ''' Regression on top of pool(), can be trained alone on stored encoder output '''
+        out = self.fc(pooled)
+#         linear_fea = torch.squeeze(linear_fea, 1)
 
         return out
 
@@ -339,12 +368,17 @@ class Decoder(nn.Module):
         else:
             self.hidden_state = hidden_state.to(device)
 
-    def get_state(self):
-        ''' Return all hidden states/cells, for decoding purpose'''
+    def select_state(self, index):
+        ''' Keep hidden states/cells of the rows at index '''
         if self.enable_cell:
-            return (self.hidden_state[0].cpu(), self.hidden_state[1].cpu())
+            self.hidden_state = (self.hidden_state[0].index_select(1, index),
+                                 self.hidden_state[1].index_select(1, index))
         else:
-            return self.hidden_state.cpu()
+            self.hidden_state = self.hidden_state.index_select(1, index)
+
+    def get_state(self):
+        ''' Return all hidden states/cells (on device), for decoding purpose'''
+        return self.hidden_state
 
     def get_query(self):
         ''' Return state of all layers as query for attention '''
@@ -416,16 +450,27 @@ class Attention(nn.Module):
     def set_mem(self, prev_attn):
         self.att_layer.set_mem(prev_attn)
 
+    def select_mem(self, index):
+        ''' Keep stored feature, mask and previous attention of the rows at index,
+            rows of dec_state in the following steps are rows of index '''
+        head = torch.arange(self.num_head, device=index.device)
+        bn_index = (index.unsqueeze(1) * self.num_head + head).view(-1)  # BxN -> BN
+        self.key = self.key.index_select(0, bn_index)
+        # Value w/o projection is shared by all heads (B rows)
+        self.value = self.value.index_select(0, bn_index if self.v_proj else index)
+        self.att_layer.select_mem(index, bn_index)
+
     def forward(self, dec_state, enc_feat, enc_len):
 
         # Preprecessing
         bs, ts, _ = enc_feat.shape
         query = torch.tanh(self.proj_q(dec_state))
-        query = query.view(bs, self.num_head, self.dim).view(
-            bs * self.num_head, self.dim)  # BNxD
+        # Rows of dec_state may differ from enc_feat once stored feature was selected (beam search)
+        query = query.view(-1, self.num_head, self.dim).view(
+            -1, self.dim)  # BNxD
 
         if self.key is None:
-            # Maskout attention score for padded states
+            # Maskout attention score for padded states (& initial alignment), kept w/ stored feature
             self.att_layer.compute_mask(enc_feat, enc_len.to(enc_feat.device))
 
             # Store enc state to lower computational cost
@@ -442,14 +487,12 @@ class Attention(nn.Module):
                         bs, ts, self.num_head, self.v_dim).permute(0, 2, 1, 3)  # BxNxTxD
                     self.value = self.value.contiguous().view(
                         bs * self.num_head, ts, self.v_dim)  # BNxTxD
-                else:
-                    self.value = self.value.repeat(self.num_head, 1, 1)
 
         # Calculate attention
         context, attn = self.att_layer(query, self.key, self.value)
         if self.num_head > 1:
             context = context.view(
-                bs, self.num_head * self.v_dim)  # BNxD  -> BxND
+                -1, self.num_head * self.v_dim)  # BNxD  -> BxND
             context = self.merge_head(context)  # BxD
 
         return attn, context
@@ -459,11 +502,13 @@ class Encoder(nn.Module):
     ''' Encoder (a.k.a. Listener in LAS)
         Encodes acoustic feature to latent representation, see config file for more details.'''
 
-    def __init__(self, input_size, vgg, module, bidirection, dim, dropout, layer_norm, proj, sample_rate, sample_style):
+    def __init__(self, input_size, vgg, module, bidirection, dim, dropout, layer_norm, proj, sample_rate, sample_style,
+                 pack=False):
         super(Encoder, self).__init__()
 
         # Hyper-parameters checking
         self.vgg = vgg
+        self.pack = pack
         self.sample_rate = 1
         assert len(sample_rate) == len(dropout), 'Number of layer mismatch'
         assert len(dropout) == len(dim), 'Number of layer mismatch'
@@ -494,6 +539,22 @@ class Encoder(nn.Module):
         self.layers = nn.ModuleList(module_list)
 
     def forward(self, input_x, enc_len):
-        for _, layer in enumerate(self.layers):
+        if not self.pack or input_x.shape[0] == 1:
+            for _, layer in enumerate(self.layers):
+                input_x, enc_len = layer(input_x, enc_len)
+            return input_x, enc_len
+
+        # Packed sequence through all RNN layers s.t. padded frames are skipped (not fed to backward direction),
+        # padded frames are masked in VGG, hence output of each utterance is the same as encoding it alone
+        layers = list(self.layers)
+        if self.vgg:
+            input_x, enc_len = layers[0](input_x, enc_len, mask_pad=True)
+            layers = layers[1:]
+        ts = input_x.shape[1]
+        input_x = pack_padded_sequence(input_x, enc_len.cpu(), batch_first=True, enforce_sorted=False)
+        for layer in layers:
             input_x, enc_len = layer(input_x, enc_len)
+            # Padded length as w/o packing
+            ts = -(-ts // layer.sample_rate) if layer.sample_style == 'drop' else ts // layer.sample_rate
+        input_x, _ = pad_packed_sequence(input_x, batch_first=True, total_length=ts)
         return input_x, enc_len
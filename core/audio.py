@@ -3,10 +3,31 @@
 # Author: kun
 # @Time: 2019-10-29 20:43
 
+import os
+import json
+import hashlib
+import numpy as np
+import soundfile as sf
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchaudio
+from torch.nn.utils.rnn import pad_sequence
+
+# Options of kaldi fbank supported by batched extraction, others fall back to per-file extraction
+BATCH_FBANK_OPTS = ["frame_length", "frame_shift", "dither"]
+# Num. of frames processed at once by batched extraction
+BATCH_FBANK_CHUNK_FRAMES = 2048
+# Same as torchaudio.compliance.kaldi
+MILLISECONDS_TO_SECONDS = 0.001
+EPSILON = torch.tensor(torch.finfo(torch.float).eps)
+# Num. of files extracted at once when filling a FeatureTable
+FEATURE_TABLE_BATCH = 32
+
+
+def _time_mask(lens, max_len):
+    # [batch, time], True for valid frames
+    return torch.arange(max_len).unsqueeze(0) < lens.unsqueeze(1)
 
 
 class CMVN(torch.jit.ScriptModule):
@@ -30,6 +51,16 @@ class CMVN(torch.jit.ScriptModule):
         if self.mode == "global":
             return (x - x.mean(self.dim, keepdim=True)) / (self.eps + x.std(self.dim, keepdim=True))
 
+    def batch(self, x, lens):
+        ''' Normalize each utterance over its own valid frames, x: [batch, channel, feature_dim, time] '''
+        mask = _time_mask(lens, x.size(-1))[:, None, None, :]
+        n = lens.to(x.dtype)[:, None, None, None]
+        x = x.masked_fill(~mask, 0)
+        mean = x.sum(-1, keepdim=True) / n
+        # Unbiased, same as Tensor.std
+        std = ((x - mean).masked_fill(~mask, 0).pow(2).sum(-1, keepdim=True) / (n - 1)).sqrt()
+        return ((x - mean) / (self.eps + std)).masked_fill(~mask, 0)
+
     def extra_repr(self):
         return "mode={}, dim={}, eps={}".format(self.mode, self.dim, self.eps)
 
@@ -56,6 +87,10 @@ class Delta(torch.jit.ScriptModule):
         x = x.unsqueeze(0)
         return F.conv2d(x, weight=self.filters, padding=self.padding)[0]
 
+    def batch(self, x, lens):
+        ''' x: [batch, 1, feature_dim, time], zero beyond lens so each utterance is zero-padded as in forward '''
+        return F.conv2d(x, weight=self.filters, padding=self.padding)
+
     # TODO(WindQAQ): find more elegant way to create `scales`
     def _create_filters(self, order, window_size):
         scales = [[1.0]]
@@ -91,6 +126,12 @@ class Postprocess(torch.jit.ScriptModule):
         # [time, channel, feature_dim] -> [time, feature_dim * channel]
         return x.reshape(x.size(0), -1).detach()
 
+    def batch(self, x, lens):
+        # [batch, channel, feature_dim, time] -> [batch, time, feature_dim * channel]
+        x = x.permute(0, 3, 1, 2)
+        x = x.reshape(x.size(0), x.size(1), -1)
+        return x.masked_fill(~_time_mask(lens, x.size(1)).unsqueeze(-1), 0).detach()
+
 
 # TODO(Windqaq): make this scriptable
 class ExtractAudioFeature(nn.Module):
@@ -111,11 +152,194 @@ class ExtractAudioFeature(nn.Module):
                             **self.kwargs)
         return y.transpose(0, 1).unsqueeze(0).detach()
 
+    def _window(self, sample_rate):
+        shift = int(sample_rate * self.kwargs.get("frame_shift", 10.0) * MILLISECONDS_TO_SECONDS)
+        size = int(sample_rate * self.kwargs.get("frame_length", 25.0) * MILLISECONDS_TO_SECONDS)
+        return size, shift
+
+    def feat_len(self, filepath):
+        ''' Num. of frames, computed from the header only (snip_edges=True) '''
+        info = sf.info(filepath)
+        size, shift = self._window(info.samplerate)
+        return 1 + (info.frames - size) // shift if info.frames >= size else 0
+
+    def batchable(self):
+        return self.mode == "fbank" and set(self.kwargs) <= set(BATCH_FBANK_OPTS) \
+            and self.kwargs.get("dither", 0) == 0
+
+    def batch(self, filepaths):
+        ''' Kaldi fbank of a batch of files in a few tensor ops.
+            Returns [batch, 1, feature_dim, time] zero-padded and lengths,
+            or (None, None) if not supported (mfcc, extra options, mixed sample rate, too short) '''
+        if not self.batchable():
+            return None, None
+        waveforms, sample_rates = zip(*[torchaudio.load(f) for f in filepaths])
+        sample_rate = sample_rates[0]
+        if any(sr != sample_rate for sr in sample_rates):
+            return None, None
+        size, shift = self._window(sample_rate)
+        # channel=-1 in forward takes the first channel
+        waveforms = [w[0] for w in waveforms]
+        if min(len(w) for w in waveforms) < max(size, 2):
+            return None, None
+        lens = torch.LongTensor([1 + (len(w) - size) // shift for w in waveforms])
+        # [batch, time, window]
+        frames = pad_sequence(waveforms, batch_first=True).unfold(1, size, shift)[:, :lens.max()]
+
+        # Work on a few utterances at a time so intermediate tensors stay in cache
+        step = max(1, BATCH_FBANK_CHUNK_FRAMES // frames.size(1))
+        y = torch.cat([self._log_fbank(frames[i:i + step], size, sample_rate)
+                       for i in range(0, len(frames), step)])
+        y = y.masked_fill(~_time_mask(lens, y.size(1)).unsqueeze(-1), 0)
+        return y.transpose(1, 2).unsqueeze(1).detach(), lens
+
+    def _log_fbank(self, frames, size, sample_rate):
+        # Remove DC offset, pre-emphasis (0.97, first sample replicated) and povey window,
+        # written straight into the zero-padded (power of 2) fft buffer
+        frames = frames - frames.mean(-1, keepdim=True)
+        padded_size = 1 << (size - 1).bit_length()
+        buffer = frames.new_zeros(frames.size(0), frames.size(1), padded_size)
+        torch.sub(frames[..., 1:], frames[..., :-1], alpha=0.97, out=buffer[..., 1:size])
+        buffer[..., 0] = frames[..., 0] * (1 - 0.97)
+        buffer[..., :size] *= torch.hann_window(size, periodic=False, dtype=frames.dtype).pow(0.85)
+        spectrum = torch.fft.rfft(buffer)
+        spectrum = spectrum.real.square() + spectrum.imag.square()
+
+        mel_banks = self._mel_banks(padded_size, sample_rate).to(spectrum.dtype)
+        return torch.max(torch.matmul(spectrum, mel_banks), EPSILON.to(spectrum.dtype)).log()
+
+    def _mel_banks(self, padded_size, sample_rate):
+        # Mel banks do not change across batches, [padded_size // 2 + 1, num_mel_bins]
+        key = (padded_size, sample_rate)
+        if getattr(self, "_mel_key", None) != key:
+            banks, _ = torchaudio.compliance.kaldi.get_mel_banks(
+                self.num_mel_bins, padded_size, float(sample_rate), 20.0, 0.0, 100.0, -500.0, 1.0)
+            self._mel = F.pad(banks, (0, 1)).T.contiguous()
+            self._mel_key = key
+        return self._mel
+
     def extra_repr(self):
         return "mode={}, num_mel_bins={}".format(self.mode, self.num_mel_bins)
 
 
+class AudioPipeline(nn.Sequential):
+    ''' Extractor, (Delta), (CMVN) and Postprocess, applied per file (forward) or per batch (batch) '''
+
+    def feat_len(self, filepath):
+        return self[0].feat_len(filepath)
+
+    def batch(self, filepaths):
+        ''' Returns zero-padded features [batch, time, dim] and lengths '''
+        x, lens = self[0].batch(filepaths)
+        if x is None:
+            # Fall back to per-file extraction
+            feats = [self(f) for f in filepaths]
+            return pad_sequence(feats, batch_first=True), torch.LongTensor([len(f) for f in feats])
+        for transform in list(self)[1:]:
+            x = transform.batch(x, lens)
+        return x, lens
+
+
+class FeatureCache(nn.Module):
+    ''' On-disk feature cache wrapping the transform pipeline.
+        Features are stored as .npy files sharded by key prefix under cache_dir/<config hash>,
+        keyed by audio path, mtime and size, and served as memory-mapped arrays on later reads.
+        Files are written to a temporary name then renamed, so DataLoader workers can share the cache. '''
+
+    def __init__(self, transform, cache_dir, config_hash):
+        super(FeatureCache, self).__init__()
+        self.transform = transform
+        self.cache_dir = os.path.join(cache_dir, config_hash)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def cache_path(self, filepath):
+        stat = os.stat(filepath)
+        key = '{}|{}|{}'.format(os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def forward(self, filepath):
+        path = self.cache_path(filepath)
+        if os.path.exists(path):
+            # Copy-on-write mapping, no data is copied until the tensor is modified
+            return torch.from_numpy(np.load(path, mmap_mode='c'))
+        feat = self.transform(filepath)
+        self.save(path, feat)
+        return feat
+
+    def feat_len(self, filepath):
+        path = self.cache_path(filepath)
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='r').shape[0]
+        return self.transform.feat_len(filepath)
+
+    def batch(self, filepaths):
+        ''' Cached features are loaded, the rest are extracted as one batch and saved '''
+        paths = [self.cache_path(f) for f in filepaths]
+        feats = [torch.from_numpy(np.load(p, mmap_mode='c')) if os.path.exists(p) else None for p in paths]
+        miss = [i for i, feat in enumerate(feats) if feat is None]
+        if len(miss) > 0:
+            x, lens = self.transform.batch([filepaths[i] for i in miss])
+            for j, i in enumerate(miss):
+                feats[i] = x[j, :lens[j]].contiguous()
+                self.save(paths[i], feats[i])
+        return pad_sequence(feats, batch_first=True), torch.LongTensor([len(feat) for feat in feats])
+
+    def save(self, path, feat):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, feat.numpy())
+            os.replace(tmp_path, path)
+        except OSError:
+            # Cache is best-effort (e.g. disk full), features are still returned
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def extra_repr(self):
+        return "cache_dir={}".format(self.cache_dir)
+
+
+class FeatureTable(nn.Module):
+    ''' In-memory features of a fixed list of files, extracted once by the transform pipeline.
+        All features are kept in one flat buffer, so share_memory() lets worker processes use a single copy. '''
+
+    def __init__(self, transform, filepaths, batch_size=FEATURE_TABLE_BATCH):
+        super(FeatureTable, self).__init__()
+        filepaths = [str(f) for f in filepaths]
+        feats = []
+        print("Extract feature of {} utterances".format(len(filepaths)))
+        with torch.no_grad():
+            for i in range(0, len(filepaths), batch_size):
+                x, lens = transform.batch(filepaths[i:i + batch_size])
+                feats += [x[j, :lens[j]] for j in range(len(lens))]
+        self.index = {f: i for i, f in enumerate(filepaths)}
+        lens = torch.LongTensor([len(feat) for feat in feats])
+        self.register_buffer('lens', lens)
+        self.register_buffer('offset', torch.cumsum(lens, 0) - lens)
+        self.register_buffer('data', torch.cat(feats, dim=0))
+
+    def forward(self, filepath):
+        i = self.index[str(filepath)]
+        return self.data[self.offset[i]:self.offset[i] + self.lens[i]]
+
+    def feat_len(self, filepath):
+        return self.lens[self.index[str(filepath)]].item()
+
+    def batch(self, filepaths):
+        feats = [self(f) for f in filepaths]
+        return pad_sequence(feats, batch_first=True), torch.LongTensor([len(feat) for feat in feats])
+
+    def extra_repr(self):
+        return "utterances={}, frames={}".format(len(self.index), len(self.data))
+
+
 def create_transform(audio_config):
+    cache_dir = audio_config.pop("cache_dir", None)
+    # Any change of feature setting invalidates the cache
+    config_hash = hashlib.sha1(json.dumps(audio_config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
     feat_type = audio_config.pop("feat_type")
     feat_dim = audio_config.pop("feat_dim")
 
@@ -132,5 +356,13 @@ def create_transform(audio_config):
         transforms.append(CMVN())
 
     transforms.append(Postprocess())
+    transform = AudioPipeline(*transforms)
+
+    if cache_dir is not None:
+        if audio_config.get("dither", 0) != 0:
+            # Dithered features are random, caching would freeze the noise
+            print("Feature cache disabled since dither = {}".format(audio_config["dither"]))
+        else:
+            transform = FeatureCache(transform, cache_dir, config_hash)
 
-    return nn.Sequential(*transforms), feat_dim * (delta_order + 1)
+    return transform, feat_dim * (delta_order + 1)
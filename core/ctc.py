@@ -4,6 +4,7 @@
 # @Time: 2019-10-29 20:45
 
 import numpy as np
+import torch
 
 
 class CTCPrefixScore(object):
@@ -113,3 +114,128 @@ class CTCPrefixScore(object):
         if self.eos in candidates:
             psi[candidates.index(self.eos)] = sum_prev[-1]
         return psi, np.rollaxis(r, 2)
+
+
+class CTCPrefixScoreTH(object):
+    '''
+    CTC Prefix score calculator in torch, for a batch of utterances and all their live hypotheses at once
+    Same recursion as CTCPrefixScore, but
+        - every token of the vocabulary is scored (one matmul in probability domain, no candidate list)
+        - the forward variables of a prefix are built in closed form (cumsum/logcumsumexp over time, no loop)
+        - state stays on the device of x, computed in float64
+        - w/ margin > 0, new tokens are only scored within margin frames of the attention peak (windowed mode)
+    Hypotheses are rows, row_utt maps each row to its utterance in the batch
+    '''
+
+    def __init__(self, x, x_len, margin=0):
+        ''' x - [BxTxV] CTC log prob., x_len - [B] valid length of each utterance, margin - 0 for exact scoring '''
+        self.logzero = -100000000.0
+        self.blank = 0
+        self.eos = 1
+        self.margin = margin
+        self.width = 2 * margin + 1
+        self.x = x.double()
+        self.x_len = x_len.to(x.device)
+        self.prob = self.x.exp()
+        self.valid = torch.arange(x.shape[1], device=x.device)[None] < self.x_len[:, None]  # BxT
+        # Accumulated blank at each step
+        self.cum_blank = torch.cumsum(self.x[:, :, self.blank], dim=1)  # BxT
+
+    def init_state(self, row_utt):
+        ''' State of the empty prefix, [KxTx2] (0 = non-blank, 1 = blank) '''
+        r = torch.full((len(row_utt), self.x.shape[1], 2), -np.inf, dtype=torch.double, device=self.x.device)
+        r[:, :, 1] = self.cum_blank[row_utt]
+        return r.masked_fill(~self.valid[row_utt, :, None], -np.inf)
+
+    def window(self, att, row_utt):
+        '''First frame of the scoring window of each row, [K]
+           att - [KxT] attention weights of each row, the window is [peak - margin, peak + margin]
+           returns None (exact scoring) if windowed mode is off or a window covers every frame'''
+        if self.margin <= 0 or att is None or self.width >= int(self.x_len[row_utt].max()):
+            return None
+        return (att.argmax(dim=-1) - self.margin).clamp(min=0)
+
+    def score(self, prefix_length, last_char, r_prev, row_utt, window=None):
+        '''Given K prefixes of the same length, return the probability of y = concat(g,c) for every token c
+           last_char - [K]     last token of each prefix (ignored if prefix_length == 0)
+           r_prev    - [KxTx2] state of each prefix
+           window    - [K]     from window(), c is only emitted within the window of each row (None: all frames)
+           returns psi [KxV]'''
+        rows = torch.arange(len(row_utt), device=row_utt.device)
+        sum_prev = torch.logaddexp(r_prev[:, :, 0], r_prev[:, :, 1])
+        # psi = sum_t phi(t-1) * x(t, c)
+        phi = self._shift(sum_prev, prefix_length, row_utt, window)
+        psi = self._logdotexp(phi, row_utt, window)
+        # Handle edge case : c == last tok of prefix, only paths ending w/ blank
+        if prefix_length > 0:
+            phi = self._shift(r_prev[:, :, 1], prefix_length, row_utt, window)
+            psi[rows, last_char] = torch.logsumexp(phi + self.x[row_utt, :, last_char], dim=-1)
+        # P(end of sentence) = P(g)
+        psi[:, self.eos] = sum_prev[rows, self.x_len[row_utt] - 1]
+        return psi.clamp(min=self.logzero)
+
+    def next_state(self, prefix_length, last_char, r_prev, row_utt, token, window=None):
+        '''State of K prefixes of length prefix_length extended by token [K], [KxTx2]
+           window - [K] same window the token was scored with'''
+        start = max(1, prefix_length)
+        rows = r_prev.shape[0]
+        sum_prev = torch.logaddexp(r_prev[:, :, 0], r_prev[:, :, 1])
+        if prefix_length > 0:
+            sum_prev = torch.where((token == last_char)[:, None], r_prev[:, :, 1], sum_prev)
+        # r(t, non-blank) = [r(t-1, non-blank) + phi(t-1)] * x(t, c)
+        cum_x = torch.cumsum(self.x[row_utt, :, token], dim=1)
+        acc = torch.full_like(cum_x, -np.inf)
+        acc[:, start:] = sum_prev[:, start - 1:-1] - cum_x[:, start - 1:-1]
+        if prefix_length == 0:
+            acc[:, 0] = 0  # r(0, non-blank) = x(0, c) if g = <sos>
+        if window is not None:
+            acc = acc.masked_fill(~self._in_window(window), -np.inf)
+        r_nonblank = cum_x + torch.logcumsumexp(acc, dim=1)
+        # r(t, blank) = [r(t-1, blank) + r(t-1, non-blank)] * x(t, blank)
+        cum_blank = self.cum_blank[row_utt]
+        acc = torch.full((rows, cum_x.shape[1]), -np.inf, dtype=torch.double, device=cum_x.device)
+        acc[:, start:] = r_nonblank[:, start - 1:-1] - cum_blank[:, start - 1:-1]
+        r_blank = cum_blank + torch.logcumsumexp(acc, dim=1)
+        r = torch.stack([r_nonblank, r_blank], dim=-1)
+        return r.masked_fill(~self.valid[row_utt, :, None], -np.inf)
+
+    def _shift(self, phi, prefix_length, row_utt, window=None):
+        ''' phi(t-1) aligned w/ x(t) for t >= max(1, prefix_length) (and within window), -inf elsewhere '''
+        start = max(1, prefix_length)
+        shifted = torch.full_like(phi, -np.inf)
+        shifted[:, start:] = phi[:, start - 1:-1]
+        if prefix_length == 0:
+            shifted[:, 0] = 0  # psi includes x(0, c) if g = <sos>
+        valid = self.valid[row_utt]
+        if window is not None:
+            valid = valid & self._in_window(window)
+        return shifted.masked_fill(~valid, -np.inf)
+
+    def _in_window(self, window):
+        frame = torch.arange(self.x.shape[1], device=window.device)[None]
+        return (frame >= window[:, None]) & (frame < window[:, None] + self.width)  # KxT
+
+    def _logdotexp(self, phi, row_utt, window=None):
+        ''' log(exp(phi) @ exp(x)) of each row w/ its utterance, [KxT] -> [KxV] '''
+        n_utt, ts, odim = self.x.shape
+        peak = phi.max(dim=1, keepdim=True)[0]
+        peak = peak.masked_fill(torch.isinf(peak), 0)
+        # Rows are placed as [utterance, rank within utterance] for one bmm
+        utt, order = torch.sort(row_utt, stable=True)
+        n_row = torch.bincount(utt, minlength=n_utt)
+        rank = torch.empty_like(order)
+        rank[order] = torch.arange(len(order), device=order.device) - (torch.cumsum(n_row, 0) - n_row)[utt]
+        prob = self.prob
+        if window is not None:
+            # Only frames covered by windows of the utterance's rows
+            first = torch.zeros_like(n_row).scatter_reduce(0, row_utt, window, 'amin', include_self=False)
+            last = torch.zeros_like(n_row).scatter_reduce(0, row_utt, (window + self.width).clamp(max=ts), 'amax',
+                                                          include_self=False)
+            frame = first[:, None] + torch.arange(int((last - first).max()), device=phi.device)[None]  # BxS
+            inside = frame < ts
+            frame = frame.clamp(max=ts - 1)
+            phi = phi.gather(1, frame[row_utt]).masked_fill(~inside[row_utt], -np.inf)
+            prob = prob.gather(1, frame[:, :, None].expand(-1, -1, odim))
+        weight = torch.zeros((n_utt, int(n_row.max()), phi.shape[1]), dtype=torch.double, device=phi.device)
+        weight[row_utt, rank] = (phi - peak).exp()
+        return torch.bmm(weight, prob)[row_utt, rank].log() + peak
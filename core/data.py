@@ -3,11 +3,15 @@
 # Author: kun
 # @Time: 2019-10-29 20:43
 
+import os
+import copy
 import torch
 from functools import partial
 from core.text import load_text_encoder
-from core.audio import create_transform
-from torch.utils.data import DataLoader
+from core.audio import create_transform, FeatureCache
+from core.embedding import EmbeddingStore, HubertEmbedding, EncoderEmbedding, encoder_signature, \
+    HUBERT_MODEL, HUBERT_DIM
+from torch.utils.data import DataLoader, Sampler
 from torch.nn.utils.rnn import pad_sequence
 import soundfile as sf
 from transformers import (
@@ -19,43 +23,81 @@ from transformers import (
 HALF_BATCHSIZE_AUDIO_LEN = 800
 # Note: Bucketing may cause random sampling to be biased (less sampled for those length > HALF_BATCHSIZE_AUDIO_LEN )
 HALF_BATCHSIZE_TEXT_LEN = 150
-
-
-def collect_audio_batch(batch, audio_transform, mode):
+# Window/shift (ms) of feature extraction if not specified in audio config (same as kaldi)
+DEFAULT_FRAME_LENGTH = 25
+DEFAULT_FRAME_SHIFT = 10
+
+
+def audio_frame_len(dur, frame_length=DEFAULT_FRAME_LENGTH, frame_shift=DEFAULT_FRAME_SHIFT, **kwargs):
+    '''Num. of feature frames of an utterance given its duration (sec.), snip_edges=True'''
+    dur = int(dur * 1000)
+    if dur < frame_length:
+        return 0
+    return 1 + int((dur - frame_length) // frame_shift)
+
+
+class FrameBudgetSampler(Sampler):
+    '''Batch sampler grouping utterances of similar length, each batch is filled up to
+       batch_frames padded frames (num. of utts x longest utt.) instead of a fixed batch size.
+       Batches are built once, their order is shuffled every epoch if shuffle=True,
+       otherwise longest batch first (shortest first if ascending=True, e.g. curriculum learning).'''
+
+    def __init__(self, frame_len, batch_frames, shuffle=False, ascending=False):
+        self.shuffle = shuffle
+        self.batches = []
+        batch = []
+        # Longest first, so the first utt. of each batch decides the padded length
+        for idx in sorted(range(len(frame_len)), key=lambda i: frame_len[i], reverse=True):
+            if len(batch) > 0 and frame_len[batch[0]] * (len(batch) + 1) > batch_frames:
+                self.batches.append(batch)
+                batch = []
+            batch.append(idx)
+        if len(batch) > 0:
+            self.batches.append(batch)
+        if ascending:
+            self.batches.reverse()
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.batches)).tolist()
+        else:
+            order = range(len(self.batches))
+        for i in order:
+            yield self.batches[i]
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def collect_audio_batch(batch, audio_transform, mode, half_batch=True):
     '''Collects a batch, should be list of tuples (audio_path <str>, list of int token <list>)
-       e.g. [(file1,txt1),(file2,txt2),...] '''
+       e.g. [(file1,txt1),(file2,txt2),...]
+       half_batch should be disabled if batches are already sized by FrameBudgetSampler '''
 
     # Bucketed batch should be [[(file1,txt1),(file2,txt2),...]]
     if type(batch[0]) is not tuple:
         batch = batch[0]
 #     print('batch:', batch)
     # Make sure that batch size is reasonable
-    first_len = audio_transform(str(batch[0][0])).shape[0]
-    if first_len > HALF_BATCHSIZE_AUDIO_LEN and mode == 'train':
-        batch = batch[:len(batch) // 2]
+    if half_batch and mode == 'train':
+        first_len = audio_transform.feat_len(str(batch[0][0]))
+        if first_len > HALF_BATCHSIZE_AUDIO_LEN:
+            batch = batch[:len(batch) // 2]
 
     # Read batch
-    file, audio_feat, audio_len, text = [], [], [], []
+    file = [str(b[0]).split('/')[-1].split('.')[0] for b in batch]
+    text = [torch.LongTensor(b[1]) for b in batch]
     with torch.no_grad():
-        for b in batch:
-            file.append(str(b[0]).split('/')[-1].split('.')[0])
-            feat = audio_transform(str(b[0]))
-            audio_feat.append(feat)
-            audio_len.append(len(feat))
-            text.append(torch.LongTensor(b[1]))
+        audio_feat, audio_len = audio_transform.batch([str(b[0]) for b in batch])
 #     print(file)
 #     print(audio_feat)
-    print(audio_len)
 #     print(text)
     # Descending audio length within each batch
-    audio_len, file, audio_feat, text = zip(*[(feat_len, f_name, feat, txt)
-                                              for feat_len, f_name, feat, txt in
-                                              sorted(zip(audio_len, file, audio_feat, text), reverse=True,
-                                                     key=lambda x: x[0])])
+    order = sorted(range(len(batch)), key=lambda i: audio_len[i], reverse=True)
+    file = tuple(file[i] for i in order)
+    audio_feat, audio_len = audio_feat[order], audio_len[order]
     # Zero-padding
-    audio_feat = pad_sequence(audio_feat, batch_first=True)
-    text = pad_sequence(text, batch_first=True)
-    audio_len = torch.LongTensor(audio_len)
+    text = pad_sequence([text[i] for i in order], batch_first=True)
 
     return file, audio_feat, audio_len, text
 
@@ -67,32 +109,22 @@ def collect_biclass_audio_batch(batch, audio_transform, mode):
     if type(batch[0]) is not tuple:
         batch = batch[0]
 #     print('batch:', batch)
-    # Make sure that batch size is reasonable
-    first_len = audio_transform(str(batch[0][0])).shape[0]
-
     # Read batch
-    file, audio_feat, audio_len, text = [], [], [], []
+    file = [str(b[0]).split('/')[-1].split('.')[0] for b in batch]
+    text = [torch.tensor([b[1]], dtype=torch.float) for b in batch]
     with torch.no_grad():
-        for b in batch:
-            file.append(str(b[0]).split('/')[-1].split('.')[0])
-            feat = audio_transform(str(b[0]))
-            audio_feat.append(feat)
-            audio_len.append(len(feat))
-            text.append(torch.tensor([b[1]], dtype=torch.float))
+        audio_feat, audio_len = audio_transform.batch([str(b[0]) for b in batch])
 #     print(file)
 #     print(audio_feat)
 #     print(audio_len)
 #     print(text)
     # Descending audio length within each batch
-    audio_len, file, audio_feat, text = zip(*[(feat_len, f_name, feat, txt)
-                                              for feat_len, f_name, feat, txt in
-                                              sorted(zip(audio_len, file, audio_feat, text), reverse=True,
-                                                     key=lambda x: x[0])])
-    # Zero-padding
-    audio_feat = pad_sequence(audio_feat, batch_first=True)
+    order = sorted(range(len(batch)), key=lambda i: audio_len[i], reverse=True)
+    file = tuple(file[i] for i in order)
+    audio_feat, audio_len = audio_feat[order], audio_len[order]
+    text = tuple(text[i] for i in order)
 #     text = pad_sequence(text, batch_first=True)
 #     text = torch.stack(text, dim=1)
-    audio_len = torch.LongTensor(audio_len)
 
     return file, audio_feat, audio_len, text[0]
 
@@ -136,9 +168,21 @@ def collect_hubert_audio_batch(batch, audio_transform, mode):
     audio_len = torch.LongTensor(audio_len)
 
     return file, audio_feat, audio_len, text[0]
-    
 
 
+def collect_embedding_batch(batch, store, mode):
+    '''Collects a batch of stored utterance embedding instead of audio feature,
+       returns embedding [B x D] (length is always 1) and label of the first sample like collect_biclass_audio_batch'''
+    # Bucketed batch should be [[(file1,txt1),(file2,txt2),...]]
+    if type(batch[0]) is not tuple:
+        batch = batch[0]
+    file = tuple(str(b[0]).split('/')[-1].split('.')[0] for b in batch)
+    emb = torch.stack([store[str(b[0])] for b in batch])
+    emb_len = torch.ones(len(batch), dtype=torch.long)
+    text = [torch.tensor([b[1]], dtype=torch.float) for b in batch]
+
+    return file, emb, emb_len, text[0]
+
 
 def collect_text_batch(batch, mode):
     '''Collects a batch of text, should be list of list of int token
@@ -158,9 +202,12 @@ def collect_text_batch(batch, mode):
     return text
 
 
-def create_dataset(tokenizer, ascending, name, path, bucketing, batch_size,
+def create_dataset(tokenizer, ascending, name, path, bucketing, batch_size, batch_frames=None,
                    train_split=None, dev_split=None, test_split=None):
     print("Interface for creating all kinds of dataset")
+    # Frame budget batching replaces bucketing (batches are built by FrameBudgetSampler)
+    if batch_frames is not None:
+        bucketing = False
 
     # Recognize dataset Mozillacv11
     if name.lower() == "librispeech":
@@ -334,22 +381,34 @@ def load_dataset(n_jobs, use_gpu, pin_memory, ascending, corpus, audio, text):
     # Dataset (in testing mode, tr_set=dv_set, dv_set=tt_set)
     tr_set, dv_set, tr_loader_bs, dv_loader_bs, mode, data_msg = create_dataset(
         tokenizer, ascending, **corpus)
+    batch_frames = corpus.get('batch_frames') if mode == 'train' else None
     # Collect function
     collect_tr = partial(collect_audio_batch,
-                         audio_transform=audio_transform, mode=mode)
+                         audio_transform=audio_transform, mode=mode, half_batch=batch_frames is None)
     collect_dv = partial(collect_audio_batch,
                          audio_transform=audio_transform, mode='test')
     # Shuffle/drop applied to training set only
     shuffle = (mode == 'train' and not ascending)
     drop_last = shuffle
     # Create data loader
-    tr_set = DataLoader(tr_set, batch_size=tr_loader_bs, shuffle=shuffle, drop_last=drop_last, collate_fn=collect_tr,
-                        num_workers=n_jobs, pin_memory=use_gpu)
+    if batch_frames is not None:
+        frame_len = [audio_frame_len(dur, **audio) for dur in tr_set.audio_dur]
+        tr_sampler = FrameBudgetSampler(frame_len, batch_frames, shuffle=shuffle, ascending=ascending)
+        tr_set = DataLoader(tr_set, batch_sampler=tr_sampler, collate_fn=collect_tr,
+                            num_workers=n_jobs, pin_memory=use_gpu)
+    else:
+        tr_set = DataLoader(tr_set, batch_size=tr_loader_bs, shuffle=shuffle, drop_last=drop_last, collate_fn=collect_tr,
+                            num_workers=n_jobs, pin_memory=use_gpu)
     dv_set = DataLoader(dv_set, batch_size=dv_loader_bs, shuffle=False, drop_last=False, collate_fn=collect_dv,
                         num_workers=n_jobs, pin_memory=pin_memory)
     # Messages to show
+    if batch_frames is not None:
+        data_msg.append('           | Frame budget = {}\t| Number of batches = {}'.format(
+            batch_frames, len(tr_sampler)))
     data_msg.append('I/O spec.  | Audio feature = {}\t| feature dim = {}\t| Token type = {}\t| Vocab size = {}'
                     .format(audio['feat_type'], feat_dim, tokenizer.token_type, tokenizer.vocab_size))
+    if isinstance(audio_transform, FeatureCache):
+        data_msg.append('           | Feature cache = {}'.format(audio_transform.cache_dir))
 
     return tr_set, dv_set, feat_dim, tokenizer.vocab_size, tokenizer, data_msg
 
@@ -387,7 +446,8 @@ def _data_msg(name, path, train_split, tr_set, dev_split, dv_set, batch_size, bu
         batch_size, bucketing))
     return msg_list
 
-def load_biclass_dataset(n_jobs, use_gpu, pin_memory, ascending, corpus, audio, text):
+def load_biclass_dataset(n_jobs, use_gpu, pin_memory, ascending, corpus, audio, text, encoder_cache=None):
+    ''' encoder_cache is used by load_encoder_cache once the model is loaded '''
     print("Prepare dataloader for training/validation")
     # Audio feature extractor
     audio_transform, feat_dim = create_transform(audio.copy())
@@ -412,22 +472,118 @@ def load_biclass_dataset(n_jobs, use_gpu, pin_memory, ascending, corpus, audio,
     # Messages to show
     data_msg.append('I/O spec.  | Audio feature = {}\t| feature dim = {}'
                     .format(audio['feat_type'], feat_dim))
+    if isinstance(audio_transform, FeatureCache):
+        data_msg.append('           | Feature cache = {}'.format(audio_transform.cache_dir))
 
     return tr_set, dv_set, feat_dim, data_msg
 
-def load_hubert_dataset(n_jobs, use_gpu, pin_memory, ascending, corpus, audio, text):
+
+def load_encoder_cache(tr_set, dv_set, model, device, encoder_cache, audio, **kwargs):
+    ''' Loaders over the same datasets as tr_set/dv_set (from load_biclass_dataset) w/ batches of stored
+        model.pool() output instead of audio feature, the frozen encoder is run once per missing utterance '''
+    audio_transform = tr_set.collate_fn.keywords['audio_transform']
+    store = EmbeddingStore(encoder_cache, encoder_signature(model, audio), model.encoder.out_dim)
+    file_list = list(tr_set.dataset.file_list) + list(dv_set.dataset.file_list)
+    if len(store.missing(file_list)) > 0:
+        store.fill(file_list, EncoderEmbedding(model, audio_transform, device))
+
+    def reload(loader):
+        # Same batching/sampling, mode of the audio collect function is kept
+        collect = partial(collect_embedding_batch, store=store, mode=loader.collate_fn.keywords['mode'])
+        return DataLoader(loader.dataset, batch_size=loader.batch_size, sampler=loader.sampler,
+                          drop_last=loader.drop_last, collate_fn=collect, num_workers=loader.num_workers,
+                          pin_memory=loader.pin_memory)
+
+    return reload(tr_set), reload(dv_set), ['           | Encoder cache = {}'.format(store.store_dir)]
+
+def create_kfold_dataset(ascending, name, path, folds, bucketing=True, batch_size=1, **kwargs):
+    ''' One dataset over all folds (single manifest), and index of utterances in each fold.
+        Each fold is a split directory under path, utterances are assigned to the fold they are stored in. '''
+    print("Interface for creating all kinds of dataset")
+
+    if name.lower() == "vag":
+        from dataset.VAGdata import VAGDataset as Dataset
+        print("import VAGDataset as Dataset")
+    elif name.lower() == "vagcdr":
+        from dataset.VAGdataCDR import VAGDataset as Dataset
+        print("import VAGDataset as Dataset")
+
+    dataset = Dataset(path, folds, 1, ascending=ascending)
+    fold_of = {s: k for k, s in enumerate(folds)}
+    fold_index = [[] for _ in folds]
+    for i, f in enumerate(dataset.file_list):
+        fold_index[fold_of[os.path.relpath(str(f), path).split(os.sep)[0]]].append(i)
+    msg_list = ['Data spec. | Corpus = {} (from {})'.format(name, path),
+                '           | {} folds = {}'.format(len(folds), ', '.join('{} ({})'.format(s, len(index))
+                                                                          for s, index in zip(folds, fold_index))),
+                '           | Batch size = {}\t\t| Bucketing = {}'.format(batch_size, bucketing)]
+    return dataset, fold_index, msg_list
+
+
+def subset_dataset(dataset, index, bucket_size):
+    ''' Dataset of utterances at index (order kept, so the subset stays sorted by duration) '''
+    subset = copy.copy(dataset)
+    subset.bucket_size = bucket_size
+    subset.file_list = tuple(dataset.file_list[i] for i in index)
+    subset.text = tuple(dataset.text[i] for i in index)
+    subset.audio_dur = tuple(dataset.audio_dur[i] for i in index)
+    return subset
+
+
+def load_kfold_dataset(ascending, corpus, audio):
+    ''' Dataset and audio transform shared by all folds of cross validation '''
+    print("Prepare dataset for cross validation")
+    audio_transform, feat_dim = create_transform(audio.copy())
+    dataset, fold_index, data_msg = create_kfold_dataset(ascending, **corpus)
+    data_msg.append('I/O spec.  | Audio feature = {}\t| feature dim = {}'
+                    .format(audio['feat_type'], feat_dim))
+    if isinstance(audio_transform, FeatureCache):
+        data_msg.append('           | Feature cache = {}'.format(audio_transform.cache_dir))
+    return dataset, fold_index, audio_transform, feat_dim, data_msg
+
+
+def create_fold_loader(dataset, index, features, mode, ascending, n_jobs, pin_memory, bucketing=True, batch_size=1,
+                       **kwargs):
+    ''' DataLoader of the utterances at index, features is an audio transform (e.g. FeatureTable)
+        or an EmbeddingStore of encoder output '''
+    if mode == 'train':
+        bucket_size = batch_size if bucketing and (not ascending) else 1
+        loader_bs = 1 if bucketing and (not ascending) else batch_size
+    else:
+        bucket_size, loader_bs = 1, 1
+    subset = subset_dataset(dataset, index, bucket_size)
+    if isinstance(features, EmbeddingStore):
+        collect = partial(collect_embedding_batch, store=features, mode=mode)
+    else:
+        collect = partial(collect_biclass_audio_batch, audio_transform=features, mode=mode)
+    # Shuffle/drop applied to training set only
+    shuffle = (mode == 'train' and not ascending)
+    return DataLoader(subset, batch_size=loader_bs, shuffle=shuffle, drop_last=shuffle, collate_fn=collect,
+                      num_workers=n_jobs, pin_memory=pin_memory)
+
+
+def load_hubert_dataset(n_jobs, use_gpu, pin_memory, ascending, corpus, audio, text, embedding_cache=None):
     print("Prepare dataloader for training/validation")
 #     # Text tokenizer
 #     tokenizer = load_text_encoder(**text)
     # Dataset (in testing mode, tr_set=dv_set, dv_set=tt_set)
     tr_set, dv_set, tr_loader_bs, dv_loader_bs, mode, data_msg = create_hubert_dataset(
         ascending, **corpus)
-    feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained("TencentGameMate/chinese-hubert-large")
-    # Collect function
-    collect_tr = partial(collect_hubert_audio_batch,
-                         audio_transform=feature_extractor, mode=mode)
-    collect_dv = partial(collect_hubert_audio_batch,
-                         audio_transform=feature_extractor, mode='test')
+    if embedding_cache is not None:
+        # Run frozen HuBERT once per utterance, batches are read from the store
+        store = EmbeddingStore(embedding_cache, HUBERT_MODEL, HUBERT_DIM)
+        file_list = list(tr_set.file_list) + list(dv_set.file_list)
+        if len(store.missing(file_list)) > 0:
+            store.fill(file_list, HubertEmbedding(torch.device('cuda') if use_gpu else torch.device('cpu')))
+        collect_tr = partial(collect_embedding_batch, store=store, mode=mode)
+        collect_dv = partial(collect_embedding_batch, store=store, mode='test')
+    else:
+        feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained("TencentGameMate/chinese-hubert-large")
+        # Collect function
+        collect_tr = partial(collect_hubert_audio_batch,
+                             audio_transform=feature_extractor, mode=mode)
+        collect_dv = partial(collect_hubert_audio_batch,
+                             audio_transform=feature_extractor, mode='test')
     # Shuffle/drop applied to training set only
     shuffle = (mode == 'train' and not ascending)
     drop_last = shuffle
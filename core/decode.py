@@ -9,10 +9,11 @@ import numpy as np
 from torch import nn
 import torch.nn.functional as F
 
-from core.lm import RNNLM
-from core.ctc import CTCPrefixScore
+from core.lm import RNNLM, RNNLMCache
+from core.ngram import load_ngram
+from core.ctc import CTCPrefixScoreTH
+from core.tap import record
 
-CTC_BEAM_RATIO = 1.5  # DO NOT CHANGE THIS, MAY CAUSE OOM
 LOG_ZERO = -10000000.0  # Log-zero for CTC
 
 
@@ -22,7 +23,8 @@ class BeamDecoder(nn.Module):
     """
 
     def __init__(self, asr, emb_decoder, beam_size, min_len_ratio, max_len_ratio,
-                 lm_path='', lm_config='', lm_weight=0.0, ctc_weight=0.0):
+                 lm_path='', lm_config='', lm_weight=0.0, ctc_weight=0.0, ctc_margin=0,
+                 ngram_path='', ngram_weight=0.0):
         super().__init__()
         # Setup
         self.beam_size = beam_size
@@ -38,17 +40,22 @@ class BeamDecoder(nn.Module):
         if self.apply_ctc:
             assert self.asr.ctc_weight > 0, 'ASR was not trained with CTC decoder'
             self.ctc_w = ctc_weight
-            self.ctc_beam_size = int(CTC_BEAM_RATIO * self.beam_size)
+            # Frames around the attention peak scored for new tokens (0 : all frames)
+            self.ctc_margin = ctc_margin
 
         self.apply_lm = lm_weight > 0
         if self.apply_lm:
             self.lm_w = lm_weight
             self.lm_path = lm_path
-            lm_config = yaml.load(open(lm_config, 'r'), Loader=yaml.FullLoader)
-            self.lm = RNNLM(self.asr.vocab_size, **lm_config['model'])
-            self.lm.load_state_dict(torch.load(
-                self.lm_path, map_location='cpu')['model'])
-            self.lm.eval()
+            self.lm = load_lm(self.asr.vocab_size, lm_path, lm_config)
+
+        # N-gram LM (w/ or instead of RNN-LM), scored on CPU
+        self.apply_ngram = ngram_weight > 0
+        if self.apply_ngram:
+            self.ngram_w = ngram_weight
+            self.ngram_path = ngram_path
+            self.ngram = load_ngram(ngram_path)
+            assert self.ngram.vocab_size == self.asr.vocab_size, 'Vocab. of n-gram LM mismatched'
 
         self.apply_emb = emb_decoder is not None
         if self.apply_emb:
@@ -59,10 +66,14 @@ class BeamDecoder(nn.Module):
             self.beam_size, self.min_len_ratio, self.max_len_ratio)]
         if self.apply_ctc:
             msg.append(
-                '           |Joint CTC decoding enabled \t| weight = {:.2f}\t'.format(self.ctc_w))
+                '           |Joint CTC decoding enabled \t| weight = {:.2f}\t| window margin = {}'.format(
+                    self.ctc_w, self.ctc_margin if self.ctc_margin > 0 else 'off'))
         if self.apply_lm:
             msg.append('           |Joint LM decoding enabled \t| weight = {:.2f}\t| core = {}'.format(
                 self.lm_w, self.lm_path))
+        if self.apply_ngram:
+            msg.append('           |Joint {}-gram LM decoding enabled \t| weight = {:.2f}\t| core = {}'.format(
+                self.ngram.order, self.ngram_w, self.ngram_path))
         if self.apply_emb:
             msg.append('           |Joint Emb. decoding enabled \t| weight = {:.2f}'.format(
                 self.lm_w, self.emb_decoder.fuse_lambda.mean().cpu().item()))
@@ -70,199 +81,395 @@ class BeamDecoder(nn.Module):
         return msg
 
     def forward(self, audio_feature, feature_len):
+        ''' Beam search of a batch of utterances, returns top (token list, score) of each utterance (list of lists) '''
         # Init.
-        assert audio_feature.shape[0] == 1, "Batchsize == 1 is required for beam search"
         batch_size = audio_feature.shape[0]
         device = audio_feature.device
-        dec_state = self.asr.decoder.init_state(
-            batch_size)  # Init zero states
-        # Max output len set w/ hyper param.
-        max_output_len = int(
-            np.ceil(feature_len.cpu().item() * self.max_len_ratio))
-        # Min output len set w/ hyper param.
-        min_output_len = int(
-            np.ceil(feature_len.cpu().item() * self.min_len_ratio))
-        # Store attention map if location-aware
-        store_att = self.asr.attention.mode == 'loc'
-        prev_token = torch.zeros(
-            (batch_size, 1), dtype=torch.long, device=device)  # Start w/ <sos>
-        # Cache of beam search
-        final_hypothesis, next_top_hypothesis = [], []
-        # Incase ctc is disabled
-        ctc_state, ctc_prob, candidates, lm_state = None, None, None, None
-
-        # Encode
+        # Max output len of each utterance set w/ hyper param.
+        max_output_len = np.ceil(feature_len.cpu().numpy() * self.max_len_ratio).astype(int)
+        # Min output len of each utterance set w/ hyper param.
+        min_output_len = np.ceil(feature_len.cpu().numpy() * self.min_len_ratio).astype(int)
+        # All states below stay on device, reordered by index_select
+        max_len = torch.from_numpy(max_output_len).to(device)  # B
+        min_len = torch.from_numpy(min_output_len).to(device)  # B
+        # Incase ctc/lm is disabled
+        ctc_state, ctc_prob, lm_node = None, None, None
+        # Tokens/scores of beam search, starts w/ one empty hypothesis per utterance.
+        # Live hypotheses of all utterances are rows of the states below (K rows), grouped by utterance.
+        store = BeamStore(batch_size, self.beam_size, int(max_output_len.max()), device)
+
+        # Encode (once for the padded batch)
         encode_feature, encode_len = self.asr.encoder(
             audio_feature, feature_len)
-        with open("./tensor_out/feature.txt", "a") as featurefile:
-            featurefile.write(f"{audio_feature} | {feature_len} | {audio_feature.size()}\n")
-        with open("./tensor_out/encoder.txt", "a") as encoderfile:
-            encoderfile.write(f"{encode_feature} | {encode_len} | {encode_feature.size()}\n")
+        record('feature', feature=audio_feature, feature_len=feature_len)
+        record('encoder', encode_feature=encode_feature, encode_len=encode_len)
         # CTC decoding
         if self.apply_ctc:
             ctc_output = F.log_softmax(
                 self.asr.ctc_layer(encode_feature), dim=-1)
-            ctc_prefix = CTCPrefixScore(ctc_output)
-            ctc_state = ctc_prefix.init_state()
-
-        # Start w/ empty hypothesis
-        prev_top_hypothesis = [Hypothesis(decoder_state=dec_state, output_seq=[],
-                                          output_scores=[], lm_state=None, ctc_prob=0,
-                                          ctc_state=ctc_state, att_map=None)]
+            # Each utterance is scored on its own length
+            ctc_prefix = CTCPrefixScoreTH(ctc_output, encode_len, self.ctc_margin)
+            ctc_state = ctc_prefix.init_state(store.row_utt)  # KxTx2
+            ctc_prob = torch.zeros(batch_size, dtype=torch.double, device=device)  # K
+
+        self.asr.decoder.init_state(batch_size)
+        self.asr.attention.reset_mem()
+        prev_token = torch.zeros(batch_size, dtype=torch.long, device=device)  # Start w/ <sos>
+        if self.apply_lm:
+            # LM prefix of each row, start w/ the empty prefix
+            lm_cache = RNNLMCache(self.lm)
+            lm_node = torch.zeros(batch_size, dtype=torch.long, device=device)  # K
+        if self.apply_ngram:
+            ngram_state = self.ngram.init_state(batch_size)  # K
         # Attention decoding
-        for t in range(max_output_len):
-            for hypothesis in prev_top_hypothesis:
-                # Resume previous step
-                prev_token, prev_dec_state, prev_attn, prev_lm_state, prev_ctc_state = hypothesis.get_state(
-                    device)
-                self.asr.set_state(prev_dec_state, prev_attn)
-
-                # Normal asr forward
-                attn, context = self.asr.attention(
-                    self.asr.decoder.get_query(), encode_feature, encode_len)
-                asr_prev_token = self.asr.pre_embed(prev_token)
-                decoder_input = torch.cat([asr_prev_token, context], dim=-1)
-                cur_prob, d_state = self.asr.decoder(decoder_input)
-                with open("./tensor_out/attention.txt", "a") as attfile:
-                    attfile.write(f"{attn} | {context} | {attn.size()}\n")
-                # Embedding fusion (output shape 1xV)
-                if self.apply_emb:
-                    _, cur_prob = self.emb_decoder(d_state, cur_prob, return_loss=False)
-                else:
-                    cur_prob = F.log_softmax(cur_prob, dim=-1)
-
-                # Perform CTC prefix scoring on limited candidates (else OOM easily)
-                if self.apply_ctc:
-                    # TODO : Check the performance drop for computing part of candidates only
-                    _, ctc_candidates = cur_prob.squeeze(0).topk(self.ctc_beam_size, dim=-1)
-                    candidates = ctc_candidates.cpu().tolist()
-                    ctc_prob, ctc_state = ctc_prefix.cheap_compute(
-                        hypothesis.outIndex, prev_ctc_state, candidates)
-                    # TODO : study why ctc_char (slightly) > 0 sometimes
-                    ctc_char = torch.FloatTensor(ctc_prob - hypothesis.ctc_prob).to(device)
-
-                    # Combine CTC score and Attention score (HACK: focus on candidates, block others)
-                    hack_ctc_char = torch.zeros_like(cur_prob).data.fill_(LOG_ZERO)
-                    for idx, char in enumerate(candidates):
-                        hack_ctc_char[0, char] = ctc_char[idx]
-                    cur_prob = (1 - self.ctc_w) * cur_prob + self.ctc_w * hack_ctc_char  # ctc_char
-                    cur_prob[0, 0] = LOG_ZERO  # Hack to ignore <sos>
-
-                # Joint RNN-LM decoding
+        for t in range(int(max_output_len.max())):
+            # Move out unfinished hyps. of utterances reaching their max len
+            ended = max_len[store.row_utt] <= t
+            if ended.any():
+                store.finish(ended.nonzero().view(-1))
+                keep = (~ended).nonzero().view(-1)
+                store.select(keep)
+                prev_token = prev_token[keep]
+                self.asr.select_state(keep)
                 if self.apply_lm:
-                    # assuming batch size always 1, resulting 1x1
-                    lm_input = prev_token.unsqueeze(1)
-                    lm_output, lm_state = self.lm(
-                        lm_input, torch.ones([batch_size]), hidden=prev_lm_state)
-                    # assuming batch size always 1,  resulting 1xV
-                    lm_output = lm_output.squeeze(0)
-                    cur_prob += self.lm_w * lm_output.log_softmax(dim=-1)
-
-                # Beam search
-                # Note: Ignored batch dim.
-                topv, topi = cur_prob.squeeze(0).topk(self.beam_size)
-                prev_attn = self.asr.attention.att_layer.prev_att.cpu() if store_att else None
-                final, top = hypothesis.addTopk(topi, topv, self.asr.decoder.get_state(), att_map=prev_attn,
-                                                lm_state=lm_state, ctc_state=ctc_state, ctc_prob=ctc_prob,
-                                                ctc_candidates=candidates)
-                # Move complete hyps. out
-                if final is not None and (t >= min_output_len):
-                    final_hypothesis.append(final)
-                    if self.beam_size == 1:
-                        return final_hypothesis
-                next_top_hypothesis.extend(top)
-
-            # Sort for top N beams
-            next_top_hypothesis.sort(key=lambda o: o.avgScore(), reverse=True)
-            prev_top_hypothesis = next_top_hypothesis[:self.beam_size]
-            next_top_hypothesis = []
+                    lm_node = lm_node[keep]
+                if self.apply_ngram:
+                    ngram_state = ngram_state[keep.cpu().numpy()]
+                if self.apply_ctc:
+                    ctc_state, ctc_prob = ctc_state[keep], ctc_prob[keep]
+            row_utt = store.row_utt
+            if len(row_utt) == 0:
+                break
+
+            # Normal asr forward (all hypotheses at once)
+            attn, context = self.asr.attention(
+                self.asr.decoder.get_query(), encode_feature, encode_len)
+            asr_prev_token = self.asr.pre_embed(prev_token)
+            decoder_input = torch.cat([asr_prev_token, context], dim=-1)
+            cur_prob, d_state = self.asr.decoder(decoder_input)
+            record('attention', attn=attn, context=context)
+            # Embedding fusion (output shape KxV)
+            if self.apply_emb:
+                _, cur_prob = self.emb_decoder(d_state, cur_prob, return_loss=False)
+            else:
+                cur_prob = F.log_softmax(cur_prob, dim=-1)
+
+            # Perform CTC prefix scoring on all tokens
+            if self.apply_ctc:
+                last_char = prev_token if t > 0 else None
+                # Window around attention peak (averaged over heads), None if disabled
+                ctc_window = ctc_prefix.window(attn.mean(dim=1), row_utt)
+                ctc_cand_prob = ctc_prefix.score(t, last_char, ctc_state, row_utt, ctc_window)  # KxV
+                ctc_char = (ctc_cand_prob - ctc_prob[:, None]).float()
+
+                # Combine CTC score and Attention score
+                cur_prob = (1 - self.ctc_w) * cur_prob + self.ctc_w * ctc_char
+                cur_prob[:, 0] = LOG_ZERO  # Hack to ignore <sos>
+
+            # Joint RNN-LM decoding
+            if self.apply_lm:
+                # One batched LM step for the prefixes not seen yet, KxV
+                lm_node, lm_prob = lm_cache.step(lm_cache.prune(lm_node), prev_token)
+                cur_prob += self.lm_w * lm_prob
+
+            # Joint n-gram LM decoding, KxV
+            if self.apply_ngram:
+                cur_prob += self.ngram_w * torch.from_numpy(self.ngram.score(ngram_state)).to(device)
+
+            # Beam search, top beam_size tokens of each hypothesis
+            topv, topi = cur_prob.topk(self.beam_size)
+            is_eos = topi == 1
+            # Move complete hyps. out
+            eos_row, eos_index = is_eos.nonzero(as_tuple=True)
+            done = min_len[row_utt[eos_row]] <= t
+            eos_row, eos_index = eos_row[done], eos_index[done]
+            store.finish(eos_row, topi[eos_row, eos_index], topv[eos_row, eos_index])
+            # Sort the rest of hypotheses of each utterance (in order of hypothesis, then token) for top N beams
+            avg_score = (store.score_sum.unsqueeze(1) + topv) / (t + 1)
+            order = (~is_eos).view(-1).nonzero().view(-1)
+            cand_utt = row_utt.repeat_interleave(self.beam_size)
+            order = order[_top_rows(avg_score.view(-1)[order], cand_utt[order], batch_size, self.beam_size)]
+            beam_index, token_index = order // self.beam_size, order % self.beam_size
+            new_token = topi[beam_index, token_index]
+
+            # Keep states of selected hypotheses
+            store.push(beam_index, new_token, topv[beam_index, token_index])
+            row_utt = store.row_utt
+            if len(row_utt) == 0:
+                # Every hypothesis ended
+                break
+            prev_token = new_token
+            self.asr.select_state(beam_index)
+            if self.apply_lm:
+                lm_node = lm_node[beam_index]
+            if self.apply_ngram:
+                ngram_state = self.ngram.next_state(ngram_state[beam_index.cpu().numpy()], new_token.cpu().numpy())
+            if self.apply_ctc:
+                ctc_prob = ctc_cand_prob[beam_index, prev_token]
+                ctc_state = ctc_prefix.next_state(t, None if last_char is None else last_char[beam_index],
+                                                  ctc_state[beam_index], row_utt, prev_token,
+                                                  None if ctc_window is None else ctc_window[beam_index])
 
         # Rescore all hyp (finished/unfinished)
-        final_hypothesis += prev_top_hypothesis
-        final_hypothesis.sort(key=lambda o: o.avgScore(), reverse=True)
-
-        return final_hypothesis[:self.beam_size]
+        store.finish(torch.arange(len(store.row_utt), device=device))
+        return store.best()
 
 
-class Hypothesis:
-    '''Hypothesis for beam search decoding.
-       Stores the history of label sequence & score
-       Stores the previous decoder state, ctc state, ctc score, lm state and attention map (if necessary)'''
+class CTCDecoder(nn.Module):
+    """
+    CTC decoder for ASR, the attention decoder is not used
+    beam_size = 1 for best path (greedy) decoding, prefix beam search w/ optional RNN-LM shallow fusion otherwise
+    """
 
-    def __init__(self, decoder_state, output_seq, output_scores, lm_state, ctc_state, ctc_prob, att_map):
-        assert len(output_seq) == len(output_scores)
-        # attention decoder
-        self.decoder_state = decoder_state
-        self.att_map = att_map
+    def __init__(self, asr, beam_size, lm_path='', lm_config='', lm_weight=0.0):
+        super().__init__()
+        # Setup
+        self.beam_size = beam_size
+        self.asr = asr
+        assert self.asr.enable_ctc, 'ASR was not trained with CTC decoder'
 
-        # RNN language model
-        if type(lm_state) is tuple:
-            self.lm_state = (lm_state[0].cpu(),
-                             lm_state[1].cpu())  # LSTM state
-        elif lm_state is None:
-            self.lm_state = None  # Init state
-        else:
-            self.lm_state = lm_state.cpu()  # GRU state
+        self.apply_lm = lm_weight > 0 and beam_size > 1
+        if self.apply_lm:
+            self.lm_w = lm_weight
+            self.lm_path = lm_path
+            self.lm = load_lm(self.asr.vocab_size, lm_path, lm_config)
 
-        # Previous outputs
-        self.output_seq = output_seq  # Prefix, List of list
-        self.output_scores = output_scores  # Prefix score, list of float
+    def create_msg(self):
+        msg = ['Decode spec| CTC {} decoding\t| Beam size = {}'.format(
+            'greedy' if self.beam_size == 1 else 'prefix beam', self.beam_size)]
+        if self.apply_lm:
+            msg.append('           |Joint LM decoding enabled \t| weight = {:.2f}\t| core = {}'.format(
+                self.lm_w, self.lm_path))
+        return msg
 
-        # CTC decoding
-        self.ctc_state = ctc_state  # List of np
-        self.ctc_prob = ctc_prob  # List of float
-
-    def avgScore(self):
-        '''Return the averaged log probability of hypothesis'''
-        assert len(self.output_scores) != 0
-        return sum(self.output_scores) / len(self.output_scores)
-
-    def addTopk(self, topi, topv, decoder_state, att_map=None,
-                lm_state=None, ctc_state=None, ctc_prob=0.0, ctc_candidates=[]):
-        '''Expand current hypothesis with a given beam size'''
-        new_hypothesis = []
-        term_score = None
-        ctc_s, ctc_p = None, None
-        beam_size = topi.shape[-1]
-
-        for i in range(beam_size):
-            # Detect <eos>
-            if topi[i].item() == 1:
-                term_score = topv[i].cpu()
-                continue
-
-            idxes = self.output_seq[:]  # pass by value
-            scores = self.output_scores[:]  # pass by value
-            idxes.append(topi[i].cpu())
-            scores.append(topv[i].cpu())
-            if ctc_state is not None:
-                # ToDo: Handle out-of-candidate case.
-                idx = ctc_candidates.index(topi[i].item())
-                ctc_s = ctc_state[idx, :, :]
-                ctc_p = ctc_prob[idx]
-            new_hypothesis.append(Hypothesis(decoder_state,
-                                             output_seq=idxes, output_scores=scores, lm_state=lm_state,
-                                             ctc_state=ctc_s, ctc_prob=ctc_p, att_map=att_map))
-        if term_score is not None:
-            self.output_seq.append(torch.tensor(1))
-            self.output_scores.append(term_score)
-            return self, new_hypothesis
-        return None, new_hypothesis
-
-    def get_state(self, device):
-        prev_token = self.output_seq[-1] if len(self.output_seq) != 0 else 0
-        prev_token = torch.LongTensor([prev_token]).to(device)
-        att_map = self.att_map.to(device) if self.att_map is not None else None
-        if type(self.lm_state) is tuple:
-            lm_state = (self.lm_state[0].to(device),
-                        self.lm_state[1].to(device))  # LSTM state
-        elif self.lm_state is None:
-            lm_state = None  # Init state
-        else:
-            lm_state = self.lm_state.to(
-                device)  # GRU state
-        return prev_token, self.decoder_state, att_map, lm_state, self.ctc_state
-
-    @property
-    def outIndex(self):
-        return [i.item() for i in self.output_seq]
+    def forward(self, audio_feature, feature_len):
+        ''' Decode a batch of utterances, returns top (token list, score) of each utterance (list of lists) '''
+        encode_feature, encode_len = self.asr.encoder(audio_feature, feature_len)
+        record('feature', feature=audio_feature, feature_len=feature_len)
+        record('encoder', encode_feature=encode_feature, encode_len=encode_len)
+        ctc_output = F.log_softmax(self.asr.ctc_layer(encode_feature), dim=-1)
+        encode_len = encode_len.to(ctc_output.device)
+        if self.beam_size == 1:
+            return self.greedy(ctc_output, encode_len)
+        return self.prefix_beam_search(ctc_output, encode_len)
+
+    def greedy(self, ctc_output, encode_len):
+        ''' Best path of each utterance, merge repeated labels then remove blanks '''
+        score, path = ctc_output.max(dim=-1)  # BxT
+        frame = torch.arange(path.shape[1], device=path.device)
+        keep = (path != 0) & (frame[None] < encode_len[:, None])
+        keep[:, 1:] &= path[:, 1:] != path[:, :-1]
+        score, path, keep = score.cpu(), path.cpu(), keep.cpu()
+        return [[(path[b][keep[b]].tolist(), float(score[b][keep[b]].mean()) if keep[b].any() else 0.0)]
+                for b in range(len(path))]
+
+    def prefix_beam_search(self, ctc_output, encode_len):
+        ''' Frame-synchronous prefix beam search of all utterances at once,
+            each frame extends the live prefixes w/ the top beam_size tokens of that frame '''
+        batch_size, _, odim = ctc_output.shape
+        device = ctc_output.device
+        # Live prefixes of all utterances are rows (K), grouped by utterance. Start w/ the empty prefix
+        row_utt = torch.arange(batch_size, device=device)  # K
+        prefix = torch.full((batch_size, 0), -1, dtype=torch.long, device=device)  # KxL, padded w/ -1
+        prefix_len = torch.zeros(batch_size, dtype=torch.long, device=device)  # K
+        last = torch.zeros(batch_size, dtype=torch.long, device=device)  # Last token (blank if empty), K
+        p_blank = torch.zeros(batch_size, device=device)  # log P(prefix, ends w/ blank), K
+        p_nonblank = torch.full((batch_size,), -np.inf, device=device)  # log P(prefix, ends w/ last token), K
+        lm_score = torch.zeros(batch_size, device=device)  # log P_lm(prefix), K
+        if self.apply_lm:
+            # LM prefix of each row (w/ <sos>), P_lm(next token | prefix) of node n is lm_cache.log_prob[n]
+            lm_cache = RNNLMCache(self.lm)
+            lm_node, _ = lm_cache.step(torch.zeros(batch_size, dtype=torch.long, device=device),
+                                       torch.zeros(batch_size, dtype=torch.long, device=device))
+        # Candidate tokens of each frame (blank excluded)
+        cand_prob, cand = ctc_output[:, :, 1:].topk(min(self.beam_size, odim - 1), dim=-1)  # BxTxC
+        cand = cand + 1
+        n_cand = cand.shape[-1]
+
+        for t in range(int(encode_len.max())):
+            n_row = len(row_utt)
+            # Utterances shorter than t keep their prefixes unchanged
+            active = encode_len[row_utt] > t
+            x_t = ctc_output[row_utt, t]  # KxV
+            p_sum = torch.logaddexp(p_blank, p_nonblank)
+            # Prefix + c : after a blank only if c is the last token
+            token = cand[row_utt, t]  # KxC
+            ext_nonblank = torch.where(token == last[:, None], p_blank[:, None], p_sum[:, None]) + \
+                cand_prob[row_utt, t]
+            ext_nonblank = ext_nonblank.masked_fill(~active[:, None], -np.inf)
+            # Same prefix : blank, or last token repeated
+            p_blank = torch.where(active, p_sum + x_t[:, 0], p_blank)
+            p_nonblank = torch.where(active, p_nonblank + x_t.gather(1, last[:, None])[:, 0], p_nonblank)
+
+            # Prefix + c merges into live prefix j if j is a child of the prefix ending w/ c
+            parent, child = _child_rows(row_utt, prefix, prefix_len, batch_size)
+            pair, c = (token[parent] == last[child, None]).nonzero(as_tuple=True)
+            parent, child = parent[pair], child[pair]
+            p_nonblank = _scatter_logsumexp(torch.cat([p_nonblank, ext_nonblank[parent, c]]),
+                                            torch.cat([torch.arange(n_row, device=device), child]), n_row)
+            ext_live = torch.isfinite(ext_nonblank)
+            ext_live[parent, c] = False
+            ext_row, c = ext_live.nonzero(as_tuple=True)
+
+            # Candidates : live prefixes, then new prefixes
+            parent = torch.cat([torch.arange(n_row, device=device), ext_row])
+            new_token = torch.cat([torch.full((n_row,), -1, dtype=torch.long, device=device), token[ext_row, c]])
+            p_blank = torch.cat([p_blank, torch.full((len(ext_row),), -np.inf, device=device)])
+            p_nonblank = torch.cat([p_nonblank, ext_nonblank[ext_row, c]])
+            lm_score = lm_score[parent]
+            if self.apply_lm:
+                lm_score[n_row:] += lm_cache.log_prob[lm_node[ext_row], new_token[n_row:]]
+
+            # Top beam_size prefixes of each utterance
+            score = torch.logaddexp(p_blank, p_nonblank)
+            if self.apply_lm:
+                score = score + self.lm_w * lm_score
+            keep = _top_rows(score, row_utt[parent], batch_size, self.beam_size)
+            parent, new_token = parent[keep], new_token[keep]
+            row_utt, p_blank, p_nonblank, lm_score = row_utt[parent], p_blank[keep], p_nonblank[keep], lm_score[keep]
+            is_ext = new_token >= 0
+            prefix_len = prefix_len[parent] + is_ext.long()
+            width = int(prefix_len.max())
+            prefix = torch.cat([prefix[parent], torch.full((len(parent), width - prefix.shape[1]), -1,
+                                                           dtype=torch.long, device=device)], dim=1)[:, :width]
+            prefix[is_ext, prefix_len[is_ext] - 1] = new_token[is_ext]
+            last = torch.where(is_ext, new_token, last[parent])
+            if self.apply_lm:
+                # Run LM on the new prefixes only
+                lm_node = lm_cache.prune(lm_node[parent])
+                ext = is_ext.nonzero().view(-1)
+                if len(ext) > 0:
+                    lm_node[ext] = lm_cache.step(lm_node[ext], new_token[ext])[0]
+
+        # P(prefix) w/ P_lm(<eos> | prefix)
+        score = torch.logaddexp(p_blank, p_nonblank)
+        if self.apply_lm:
+            score = score + self.lm_w * (lm_score + lm_cache.log_prob[lm_node, 1])
+        keep = _top_rows(score, row_utt, batch_size, self.beam_size)
+        final_hypothesis = [[] for _ in range(batch_size)]
+        prefix, prefix_len, score = prefix.cpu(), prefix_len.cpu(), score.cpu()
+        for k in keep.tolist():
+            # Length-normalized score, as beam decoder
+            final_hypothesis[row_utt[k]].append(
+                (prefix[k, :prefix_len[k]].tolist(), float(score[k]) / max(1, int(prefix_len[k]))))
+        return final_hypothesis
+
+
+def load_lm(vocab_size, lm_path, lm_config):
+    ''' Load RNN-LM for shallow fusion in eval mode '''
+    lm_config = yaml.load(open(lm_config, 'r'), Loader=yaml.FullLoader)
+    lm = RNNLM(vocab_size, **lm_config['model'])
+    lm.load_state_dict(torch.load(lm_path, map_location='cpu')['model'])
+    return lm.eval()
+
+
+def _top_rows(score, row_utt, batch_size, beam_size):
+    ''' Index of the top beam_size rows of each utterance, grouped by utterance, in descending score '''
+    order = torch.sort(score, descending=True, stable=True)[1]
+    order = order[torch.sort(row_utt[order], stable=True)[1]]
+    n_row = torch.bincount(row_utt[order], minlength=batch_size)
+    rank = torch.arange(len(order), device=order.device) - (torch.cumsum(n_row, 0) - n_row)[row_utt[order]]
+    return order[rank < beam_size]
+
+
+def _child_rows(row_utt, prefix, prefix_len, batch_size):
+    ''' Pairs of rows (i, j) of the same utterance where prefix j is prefix i + one token, rows grouped by utterance '''
+    n_row = torch.bincount(row_utt, minlength=batch_size)
+    row_start = torch.cumsum(n_row, 0) - n_row
+    rank = torch.arange(len(row_utt), device=row_utt.device) - row_start[row_utt]
+    # Prefixes of each utterance, BxNxL
+    grid = torch.full((batch_size, int(n_row.max()), prefix.shape[1]), -1, dtype=torch.long, device=prefix.device)
+    grid[row_utt, rank] = prefix
+    grid_len = torch.full((batch_size, grid.shape[1]), -2, dtype=torch.long, device=prefix.device)
+    grid_len[row_utt, rank] = prefix_len
+    # j starts w/ prefix i and is one token longer
+    pos = torch.arange(prefix.shape[1], device=prefix.device)
+    same = ((grid[:, :, None] == grid[:, None]) | (pos >= grid_len[:, :, None, None])).all(dim=-1)  # BxNxN
+    utt, i, j = (same & (grid_len[:, None, :] == grid_len[:, :, None] + 1)).nonzero(as_tuple=True)
+    return row_start[utt] + i, row_start[utt] + j
+
+
+def _scatter_logsumexp(src, index, size):
+    ''' log(sum(exp(src))) of entries w/ the same index, [size] '''
+    peak = torch.full((size,), -np.inf, dtype=src.dtype, device=src.device).scatter_reduce(0, index, src, 'amax')
+    peak = peak.masked_fill(torch.isinf(peak), 0)
+    total = torch.zeros_like(peak).scatter_add(0, index, (src - peak[index]).exp())
+    return total.log() + peak
+
+
+class BeamStore:
+    '''Hypotheses of beam search decoding in preallocated tensors.
+       Step s of row k holds its token & the row at step s-1 it extends (backpointer),
+       only the running score sum of live rows is kept. Sequences are backtracked at the end.
+       Stored steps are never rewritten, live row k is row live[k] of the last step.'''
+
+    def __init__(self, batch_size, beam_size, max_len, device='cpu'):
+        self.batch_size = batch_size
+        self.beam_size = beam_size
+        n_row = batch_size * beam_size
+        self.token = torch.zeros((max_len, n_row), dtype=torch.long, device=device)  # LxK
+        self.backptr = torch.zeros((max_len, n_row), dtype=torch.long, device=device)  # LxK
+        self.n_step = 0
+        # Live rows (one empty hypothesis per utterance before 1st step)
+        self.row_utt = torch.arange(batch_size, device=device)  # K
+        self.live = torch.arange(batch_size, device=device)  # K
+        self.score_sum = torch.zeros(batch_size, device=device)  # K
+        # Finished hypotheses : last step, row at that step, extra token (-1 if none), length, utterance
+        self.final = torch.zeros((2 * n_row, 5), dtype=torch.long, device=device)
+        self.final_sum = torch.zeros(2 * n_row, device=device)
+        self.n_final = 0
+
+    def push(self, backptr, token, score):
+        '''New step, live row k extends row backptr[k] w/ token[k] of score[k]'''
+        n_row = len(token)
+        self.token[self.n_step, :n_row] = token
+        self.backptr[self.n_step, :n_row] = self.live[backptr]
+        self.live = torch.arange(n_row, device=self.live.device)
+        self.row_utt = self.row_utt[backptr]
+        self.score_sum = self.score_sum[backptr] + score
+        self.n_step += 1
+
+    def select(self, index):
+        '''Keep the live rows in index only (rows already finished keep pointing to the last step)'''
+        self.live = self.live[index]
+        self.row_utt = self.row_utt[index]
+        self.score_sum = self.score_sum[index]
+
+    def finish(self, rows, token=None, score=None):
+        '''Move live rows (extended by token of score if given, e.g. <eos>) to finished hypotheses'''
+        n = len(rows)
+        if self.n_final + n > len(self.final):
+            # Grow by doubling
+            size = max(self.n_final + n, 2 * len(self.final))
+            self.final = torch.cat([self.final, self.final.new_zeros((size - len(self.final), 5))])
+            self.final_sum = torch.cat([self.final_sum, self.final_sum.new_zeros(size - len(self.final_sum))])
+        final = self.final[self.n_final:self.n_final + n]
+        final[:, 0] = self.n_step - 1
+        final[:, 1] = self.live[rows]
+        final[:, 2] = -1 if token is None else token
+        final[:, 3] = self.n_step + (token is not None)
+        final[:, 4] = self.row_utt[rows]
+        self.final_sum[self.n_final:self.n_final + n] = self.score_sum[rows] + (0 if score is None else score)
+        self.n_final += n
+
+    def best(self):
+        '''Top beam_size finished hypotheses of each utterance by averaged log probability,
+           returns list (utterance) of lists of (token list, score)'''
+        step, row, token, length, utt = self.final[:self.n_final].t()
+        avg_score = self.final_sum[:self.n_final] / length.clamp(min=1)
+        keep = _top_rows(avg_score, utt, self.batch_size, self.beam_size)
+        step, row, token, length, utt, avg_score = \
+            step[keep], row[keep], token[keep], length[keep], utt[keep], avg_score[keep]
+        # Backtrack all hypotheses at once
+        seq = torch.zeros((len(keep), self.n_step + 1), dtype=torch.long, device=keep.device)  # NxL
+        extra = token >= 0
+        seq[extra, length[extra] - 1] = token[extra]
+        for s in range(int(step.max()) if len(keep) > 0 else -1, -1, -1):
+            on = (step >= s).nonzero().view(-1)
+            seq[on, s] = self.token[s, row[on]]
+            row[on] = self.backptr[s, row[on]]
+        final_hypothesis = [[] for _ in range(self.batch_size)]
+        seq = seq.tolist()
+        for k, (u, l, score) in enumerate(zip(utt.tolist(), length.tolist(), avg_score.tolist())):
+            final_hypothesis[u].append((seq[k][:l], score))
+        return final_hypothesis
@@ -0,0 +1,149 @@
+#! python
+# -*- coding: utf-8 -*-
+# Author: kun
+# @Time: 2019-10-29 20:39
+
+import os
+import json
+import fcntl
+import hashlib
+import numpy as np
+import torch
+import soundfile as sf
+from tqdm import tqdm
+
+# Frozen model used by Hubert_Classifier
+HUBERT_MODEL = "TencentGameMate/chinese-hubert-large"
+# Hidden size of HUBERT_MODEL
+HUBERT_DIM = 1024
+# Index is written every N stored utterances, so an interrupted extraction can be resumed
+INDEX_SAVE_STEP = 200
+# Parameters trained on stored encoder output, which is only valid if the encoder stays frozen
+CACHED_NONFREEZE_KEYS = ['fc.weight', 'fc.bias']
+
+
+class EmbeddingStore(object):
+    ''' Memory-mapped store of fixed-size utterance embeddings (outputs of a frozen model), one row per utterance.
+        Rows are appended to emb.f32 under store_dir/<name>, index.json maps audio (path, mtime, size) to row. '''
+
+    def __init__(self, store_dir, name, dim):
+        self.name = name
+        self.dim = dim
+        self.store_dir = os.path.join(store_dir, name.replace('/', '_'))
+        self.index_file = os.path.join(self.store_dir, 'index.json')
+        self.data_file = os.path.join(self.store_dir, 'emb.f32')
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.index = self._load_index()
+        self._emb = None
+
+    def key(self, filepath):
+        stat = os.stat(filepath)
+        key = '{}|{}|{}'.format(os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def __contains__(self, filepath):
+        return self.key(filepath) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, filepath):
+        ''' Embedding of an utterance, [dim] '''
+        row = self.index[self.key(filepath)]
+        if self._emb is None or row >= len(self._emb):
+            # (Re)map after rows were appended
+            self._emb = np.memmap(self.data_file, dtype=np.float32, mode='r').reshape(-1, self.dim)
+        return torch.from_numpy(np.array(self._emb[row]))
+
+    def missing(self, filepaths):
+        return [str(f) for f in filepaths if str(f) not in self]
+
+    def fill(self, filepaths, embed):
+        ''' Store embed(filepath) ([dim] tensor) of every utterance not stored yet '''
+        with open(self.data_file, 'ab') as f:
+            # One writer at a time, others wait and reuse what was stored
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self.index = self._load_index()
+            # Drop rows written after the last index save of an interrupted run
+            f.truncate(len(self.index) * self.dim * 4)
+            missing = self.missing(filepaths)
+            print("Store embedding of {} utterances to {}".format(len(missing), self.store_dir))
+            for i, filepath in enumerate(tqdm(missing)):
+                f.write(embed(filepath).float().cpu().numpy().tobytes())
+                self.index[self.key(filepath)] = len(self.index)
+                if (i + 1) % INDEX_SAVE_STEP == 0:
+                    f.flush()
+                    self._save_index()
+            f.flush()
+            self._save_index()
+        self._emb = None
+
+    def _load_index(self):
+        if not os.path.exists(self.index_file):
+            return {}
+        with open(self.index_file, 'r') as f:
+            return json.load(f)
+
+    def _save_index(self):
+        tmp_file = '{}.{}.tmp'.format(self.index_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_file, self.index_file)
+
+
+class HubertEmbedding(object):
+    ''' last_hidden_state[0][-1] of frozen HuBERT (the vector Hubert_Classifier.fc takes) '''
+
+    def __init__(self, device, model_path=HUBERT_MODEL):
+        from transformers import Wav2Vec2FeatureExtractor, HubertModel
+        self.device = device
+        self.feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(model_path)
+        self.model = HubertModel.from_pretrained(model_path).to(device)
+        self.model.eval()
+
+    def __call__(self, filepath):
+        wav, sr = sf.read(filepath)
+        input_values = self.feature_extractor(wav, return_tensors="pt", sampling_rate=sr).input_values
+        with torch.no_grad():
+            last_hidden_state = self.model(input_values.to(self.device)).last_hidden_state
+        return last_hidden_state[0][-1]
+
+
+class EncoderEmbedding(object):
+    ''' model.pool() of an utterance (frozen encoder of Encoder_Classifier/Encoder_CDR), run in eval mode '''
+
+    def __init__(self, model, audio_transform, device):
+        self.model = model
+        self.audio_transform = audio_transform
+        self.device = device
+
+    def __call__(self, filepath):
+        training = self.model.training
+        self.model.eval()
+        with torch.no_grad():
+            feat = self.audio_transform(filepath).unsqueeze(0).to(self.device)
+            pooled = self.model.pool(feat, torch.LongTensor([feat.shape[1]]).to(self.device))
+        self.model.train(training)
+        return pooled
+
+
+def encoder_signature(model, audio_config):
+    ''' Name of the store holding outputs of this encoder on these features '''
+    sign = hashlib.sha1(json.dumps(audio_config, sort_keys=True).encode('utf-8'))
+    for name, param in sorted(model.encoder.state_dict().items()):
+        sign.update(name.encode('utf-8'))
+        sign.update(param.detach().cpu().numpy().tobytes())
+    return 'encoder-{}'.format(sign.hexdigest()[:16])
+
+
+def cached_nonfreeze_keys(nonfreeze_keys):
+    ''' Parameters trained w/ encoder cache instead of nonfreeze_keys, warns about the ones left frozen.
+        Stored encoder output is computed in eval mode (no dropout), unlike the forward pass in training '''
+    frozen = [k for k in nonfreeze_keys if k not in CACHED_NONFREEZE_KEYS]
+    if len(frozen) > 0:
+        print('[WARNING] Encoder cache enabled, {} encoder parameters fine-tuned w/o cache stay frozen :'.format(
+            len(frozen)))
+        for k in frozen:
+            print('[WARNING]     {}'.format(k))
+    print('[WARNING] Stored encoder output is computed in eval mode (no encoder dropout during training).')
+    return list(CACHED_NONFREEZE_KEYS)
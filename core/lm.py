@@ -8,6 +8,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+LM_CACHE_SIZE = 8192  # Max. # of cached prefixes before pruning to the live ones
+
 
 class RNNLM(nn.Module):
     ''' RNN Language Model '''
@@ -49,3 +51,72 @@ class RNNLM(nn.Module):
         else:
             outputs = self.trans(self.dp2(outputs))
         return outputs, hidden
+
+    def step(self, x, hidden=None):
+        ''' Single step of all rows w/o packing, x : token [K], returns log P(next token) [KxV] and hidden '''
+        emb_x = self.dp1(self.emb(x.unsqueeze(1)))
+        if not self.training:
+            self.rnn.flatten_parameters()
+        outputs, hidden = self.rnn(emb_x, hidden)
+        outputs = self.dp2(outputs.squeeze(1))
+        if self.emb_tying:
+            outputs = F.linear(outputs, self.emb.weight)
+        else:
+            outputs = self.trans(outputs)
+        return outputs.log_softmax(dim=-1), hidden
+
+
+class RNNLMCache(object):
+    ''' Prefix-keyed RNNLM states for decoding
+        Prefixes are nodes of a prefix tree (node 0 : empty prefix), each extended by (node, token) once,
+        hidden state & log P(next token) of a prefix are shared by all hypotheses w/ that prefix '''
+
+    def __init__(self, lm, max_size=LM_CACHE_SIZE):
+        self.lm = lm
+        self.max_size = max_size
+        self.enable_cell = isinstance(lm.rnn, nn.LSTM)
+        param = next(lm.parameters())
+        self.child = {}  # (node, token) -> node
+        self.size = 1
+        # Storage, grown by doubling
+        self.hidden = param.new_zeros((2 if self.enable_cell else 1, lm.n_layers, 1, lm.dim))  # SxLxNxD
+        self.log_prob = param.new_zeros((1, lm.vocab_size))  # NxV
+
+    def __len__(self):
+        return self.size
+
+    def step(self, node, token):
+        ''' Extend prefixes (node) w/ token, returns node of the new prefixes & their log P(next token) [KxV],
+            only unseen (node, token) pairs are fed to LM '''
+        key = list(zip(node.tolist(), token.tolist()))
+        new_key = [k for k in dict.fromkeys(key) if k not in self.child]
+        if len(new_key) > 0:
+            parent, new_token = torch.tensor(new_key, device=node.device).t()
+            hidden = self.hidden[:, :, parent]
+            log_prob, hidden = self.lm.step(new_token, (hidden[0], hidden[1]) if self.enable_cell else hidden[0])
+            hidden = torch.stack(hidden) if self.enable_cell else hidden.unsqueeze(0)
+            if self.size + len(new_key) > self.log_prob.shape[0]:
+                capacity = max(self.size + len(new_key), 2 * self.log_prob.shape[0])
+                self.hidden = torch.cat([self.hidden, self.hidden.new_zeros(
+                    self.hidden.shape[:2] + (capacity - self.hidden.shape[2], self.lm.dim))], dim=2)
+                self.log_prob = torch.cat([self.log_prob, self.log_prob.new_zeros(
+                    (capacity - self.log_prob.shape[0], self.lm.vocab_size))])
+            self.hidden[:, :, self.size:self.size + len(new_key)] = hidden
+            self.log_prob[self.size:self.size + len(new_key)] = log_prob
+            for k in new_key:
+                self.child[k] = self.size
+                self.size += 1
+        child = torch.tensor([self.child[k] for k in key], dtype=torch.long, device=node.device)
+        return child, self.log_prob[child]
+
+    def prune(self, node):
+        ''' Drop all prefixes but node (live hypotheses) once cache exceeds max. size, returns their new node '''
+        if self.size <= self.max_size:
+            return node
+        keep, new_node = torch.unique(torch.cat([node.new_zeros(1), node]), return_inverse=True)
+        remap = {n: i for i, n in enumerate(keep.tolist())}
+        self.child = {(remap[p], t): remap[c] for (p, t), c in self.child.items() if p in remap and c in remap}
+        self.hidden = self.hidden[:, :, keep]
+        self.log_prob = self.log_prob[keep]
+        self.size = len(keep)
+        return new_node[1:]
@@ -6,7 +6,7 @@
 import torch
 import numpy as np
 import torch.nn as nn
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, PackedSequence
 
 
 class VGGExtractor(nn.Module):
@@ -59,11 +59,23 @@ class VGGExtractor(nn.Module):
 
         return feature, feat_len
 
-    def forward(self, feature, feat_len):
+    def forward(self, feature, feat_len, mask_pad=False):
         # Feature shape BSxTxD -> BS x CH(num of delta) x T x D(acoustic feature dim)
         feature, feat_len = self.view_input(feature, feat_len)
         # Foward
-        feature = self.extractor(feature)
+        if mask_pad:
+            # Zero out padded frames before each conv (as zero padding of conv) s.t. output frames don't depend on padding
+            scale = 4
+            for layer in self.extractor:
+                if isinstance(layer, nn.Conv2d):
+                    valid = torch.arange(feature.shape[2], device=feature.device) < \
+                        (feat_len * scale).to(feature.device).unsqueeze(1)  # BSxT
+                    feature = feature * valid[:, None, :, None]
+                elif isinstance(layer, nn.MaxPool2d):
+                    scale //= 2
+                feature = layer(feature)
+        else:
+            feature = self.extractor(feature)
         # BSx128xT/4xD/4 -> BSxT/4x128xD/4
         feature = feature.transpose(1, 2)
         #  BS x T/4 x 128 x D/4 -> BS x T/4 x 32D
@@ -105,13 +117,15 @@ class RNNLayer(nn.Module):
             self.pj = nn.Linear(rnn_out_dim, rnn_out_dim)
 
     def forward(self, input_x, x_len):
+        ''' input_x is either padded BxTxD or packed (see Encoder), output is of the same kind '''
         # Forward RNN
         if not self.training:
             self.layer.flatten_parameters()
-        # ToDo: check time efficiency of pack/pad
-        # input_x = pack_padded_sequence(input_x, x_len, batch_first=True, enforce_sorted=False)
         output, _ = self.layer(input_x)
-        # output,x_len = pad_packed_sequence(output,batch_first=True)
+        packed = isinstance(output, PackedSequence)
+        if packed:
+            # Following ops are applied on data of packed sequence, NxD
+            output, batch_sizes = output.data, output.batch_sizes
 
         # Normalizations
         if self.layer_norm:
@@ -120,7 +134,10 @@ class RNNLayer(nn.Module):
             output = self.dp(output)
 
         # Perform Downsampling
-        if self.sample_rate > 1:
+        if self.sample_rate > 1 and packed:
+            x_len = x_len // self.sample_rate
+            output, batch_sizes = self._downsample_packed(output, batch_sizes)
+        elif self.sample_rate > 1:
             batch_size, timestep, feature_dim = output.shape
             x_len = x_len // self.sample_rate
 
@@ -137,8 +154,28 @@ class RNNLayer(nn.Module):
         if self.proj:
             output = torch.tanh(self.pj(output))
 
+        if packed:
+            output = PackedSequence(output, batch_sizes, input_x.sorted_indices, input_x.unsorted_indices)
         return output, x_len
 
+    def _downsample_packed(self, data, batch_sizes):
+        ''' Downsampling on data of packed sequence (time-major, sorted by length), same frames as padded ones
+            Returns data & batch sizes (both w/ new time steps T'), batch_sizes is on cpu '''
+        rate = self.sample_rate
+        # Length of each sorted sequence after downsampling, B
+        seq_len = (batch_sizes.unsqueeze(0) > torch.arange(int(batch_sizes[0])).unsqueeze(1)).sum(1) // rate
+        assert seq_len[-1] > 0, 'Sequence too short for encoder downsampling rate'
+        new_sizes = (seq_len.unsqueeze(0) > torch.arange(int(seq_len[0])).unsqueeze(1)).sum(1)  # T'
+        # Frames (time step, sequence) kept, N'
+        step = torch.repeat_interleave(torch.arange(len(new_sizes)), new_sizes)
+        seq = torch.arange(len(step)) - torch.repeat_interleave(torch.cumsum(new_sizes, 0) - new_sizes, new_sizes)
+        # Rows of data to keep, N'x1 for drop, N'xR (frames to concat) for concat
+        offset = torch.cumsum(batch_sizes, 0) - batch_sizes
+        sub_step = torch.arange(rate if self.sample_style == 'concat' else 1)
+        index = offset[step.unsqueeze(1) * rate + sub_step] + seq.unsqueeze(1)
+        data = data.index_select(0, index.view(-1).to(data.device)).view(len(step), -1)
+        return data, new_sizes
+
 
 class BaseAttention(nn.Module):
     ''' Base module for attentions '''
@@ -158,22 +195,24 @@ class BaseAttention(nn.Module):
     def set_mem(self):
         pass
 
+    def select_mem(self, index, bn_index):
+        self.mask = self.mask.index_select(0, bn_index)
+        self.k_len = self.k_len.index_select(0, index)
+
     def compute_mask(self, k, k_len):
-        # Make the mask for padded states
+        # Make the mask for padded states, on the device of k_len
         self.k_len = k_len
         bs, ts, _ = k.shape
-        self.mask = np.zeros((bs, self.num_head, ts))
-        for idx, sl in enumerate(k_len):
-            self.mask[idx, :, sl:] = 1  # ToDo: more elegant way?
-        self.mask = torch.from_numpy(self.mask).to(
-            k_len.device, dtype=torch.bool).view(-1, ts)  # BNxT
+        pad = torch.arange(ts, device=k_len.device).unsqueeze(0) >= k_len.unsqueeze(1)  # BxT
+        self.mask = pad.unsqueeze(1).expand(bs, self.num_head, ts).reshape(-1, ts)  # BNxT
 
     def _attend(self, energy, value):
+        ''' value is either BNxTxD or BxTxD (shared by all heads) '''
         attn = energy / self.temperature
         attn = attn.masked_fill(self.mask, -np.inf)
         attn = self.softmax(attn)  # BNxT
-        output = torch.bmm(attn.unsqueeze(1), value).squeeze(
-            1)  # BNxT x BNxTxD-> BNxD
+        output = torch.bmm(attn.view(value.shape[0], -1, attn.shape[-1]), value).view(
+            -1, value.shape[-1])  # BNxT x BNxTxD (or BxNxT x BxTxD) -> BNxD
         return output, attn
 
 
@@ -200,6 +239,7 @@ class LocationAwareAttention(BaseAttention):
     def __init__(self, kernel_size, kernel_num, dim, num_head, temperature):
         super().__init__(temperature, num_head)
         self.prev_att = None
+        self.init_att = None
         self.loc_conv = nn.Conv1d(
             num_head, kernel_num, kernel_size=2 * kernel_size + 1, padding=kernel_size, bias=False)
         self.loc_proj = nn.Linear(kernel_num, dim, bias=False)
@@ -209,30 +249,41 @@ class LocationAwareAttention(BaseAttention):
     def reset_mem(self):
         super().reset_mem()
         self.prev_att = None
+        self.init_att = None
 
     def set_mem(self, prev_att):
         self.prev_att = prev_att
 
+    def select_mem(self, index, bn_index):
+        super().select_mem(index, bn_index)
+        self.init_att = self.init_att.index_select(0, index)
+        if self.prev_att is not None:
+            self.prev_att = self.prev_att.index_select(0, index)
+
+    def compute_mask(self, k, k_len):
+        super().compute_mask(k, k_len)
+        # Uniform alignment over unpadded states as initial prev_att
+        bs, ts, _ = k.shape
+        self.init_att = (~self.mask).view(bs, self.num_head, ts).float() / \
+            k_len.clamp(min=1).view(-1, 1, 1).float()  # BxNxT
+
     def forward(self, q, k, v):
         bs_nh, ts, _ = k.shape
         bs = bs_nh // self.num_head
 
         # Uniformly init prev_att
         if self.prev_att is None:
-            self.prev_att = torch.zeros((bs, self.num_head, ts)).to(k.device)
-            for idx, sl in enumerate(self.k_len):
-                self.prev_att[idx, :, :sl] = 1.0 / sl
+            self.prev_att = self.init_att
 
-        # Calculate location context
+        # Calculate location context, shared by all heads
         loc_context = torch.tanh(self.loc_proj(self.loc_conv(
             self.prev_att).transpose(1, 2)))  # BxNxT->BxTxD
-        loc_context = loc_context.unsqueeze(1).repeat(
-            1, self.num_head, 1, 1).view(-1, ts, self.dim)  # BxNxTxD -> BNxTxD
-        q = q.unsqueeze(1)  # BNx1xD
+        k = k.view(bs, self.num_head, ts, self.dim)  # BNxTxD -> BxNxTxD
+        q = q.view(bs, self.num_head, 1, self.dim)  # BNxD -> BxNx1xD
 
         # Compute energy and context
         energy = self.gen_energy(torch.tanh(
-            k + q + loc_context)).squeeze(2)  # BNxTxD -> BNxT
+            k + q + loc_context.unsqueeze(1))).view(-1, ts)  # BxNxTxD -> BNxT
         output, attn = self._attend(energy, v)
         attn = attn.view(bs, self.num_head, ts)  # BNxT -> BxNxT
         self.prev_att = attn
@@ -0,0 +1,169 @@
+#! python
+# -*- coding: utf-8 -*-
+# Author: kun
+# @Time: 2019-10-29 20:45
+
+import codecs
+import numpy as np
+
+SPACE_UNIT = '<space>'  # ARPA unit of the space token (character mode)
+LOG10 = np.log(10.0)  # ARPA scores are log10
+
+
+def token_units(tokenizer):
+    ''' ARPA unit of each token id, <s> shares id 0 w/ <pad> (<sos> of decoding) '''
+    if tokenizer.token_type in ['character', 'word']:
+        units = [tokenizer.idx_to_vocab(idx) for idx in range(tokenizer.vocab_size)]
+    elif tokenizer.token_type == 'subword':
+        units = [tokenizer.spm.id_to_piece(idx) for idx in range(tokenizer.vocab_size)]
+    else:
+        raise NotImplementedError(
+            'N-gram LM of `{}` tokens is not supported.'.format(tokenizer.token_type))
+    units[tokenizer.pad_idx] = '<s>'
+    units[tokenizer.eos_idx] = '</s>'
+    units[tokenizer.unk_idx] = '<unk>'
+    return [SPACE_UNIT if u == ' ' else u for u in units]
+
+
+class NgramLM(object):
+    ''' Backoff n-gram LM over token ids, stored as an array-backed trie
+        Node 0 is the empty context, every other node is one n-gram w/ its parent (n-1)-gram,
+        nodes are sorted by (order, parent, token) so children of a node are contiguous.
+        A decoding state is the node of the longest known context (at most n-1 tokens) '''
+
+    def __init__(self, vocab_size, order, token, parent, suffix, logp, backoff, unk_logp):
+        self.vocab_size = vocab_size
+        self.order = order
+        self.token = token  # int32, N
+        self.parent = parent  # int32, N
+        self.suffix = suffix  # Node w/o the 1st token, int32, N
+        self.logp = logp  # ln P(token | parent), float32, N
+        self.backoff = backoff  # ln backoff weight as context, float32, N
+        self.unk_logp = unk_logp  # ln P(<unk>) for tokens missing in the LM
+        # Search key & children range of each node
+        self.key = parent.astype(np.int64) * vocab_size + token
+        node = np.arange(len(token))
+        self.child_start = np.searchsorted(parent, node, side='left')
+        self.child_end = np.searchsorted(parent, node, side='right')
+        # Dense unigram, tokens missing in the LM are <unk>
+        self.unigram = np.full(vocab_size, unk_logp, dtype=np.float32)
+        self.unigram[token[self.child_start[0]:self.child_end[0]]] = logp[self.child_start[0]:self.child_end[0]]
+        # Order of each node (0 : empty context)
+        self.depth = np.zeros(len(token), dtype=np.int8)
+        for _ in range(order):
+            self.depth[1:] = self.depth[parent[1:]] + 1
+
+    def __len__(self):
+        return len(self.token)
+
+    def create_msg(self):
+        return ['Model spec.| {}-gram LM, vocab size = {}, # of n-grams = {}'.format(
+            self.order, self.vocab_size, len(self) - 1)]
+
+    def lookup(self, node, token):
+        ''' Child of each node w/ token, -1 if not found '''
+        key = node.astype(np.int64) * self.vocab_size + token
+        idx = np.searchsorted(self.key, key).clip(max=len(self.key) - 1)
+        return np.where(self.key[idx] == key, idx, -1)
+
+    def init_state(self, n):
+        ''' States of n sentences right after <s> '''
+        state = self.lookup(np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64))
+        return np.maximum(state, 0)
+
+    def next_state(self, state, token):
+        ''' States after feeding token to each state '''
+        # Context is at most n-1 tokens
+        node = np.where(self.depth[state] == self.order - 1, self.suffix[state], state)
+        new_state = np.zeros(len(state), dtype=np.int64)
+        row = np.arange(len(state))
+        while len(row) > 0:
+            child = self.lookup(node, token[row])
+            found = child >= 0
+            new_state[row[found]] = child[found]
+            # Back off to shorter context, unknown at the empty context
+            cont = (~found) & (node > 0)
+            row, node = row[cont], self.suffix[node[cont]]
+        return new_state
+
+    def score(self, state):
+        ''' ln P(token | state) of all tokens, KxV '''
+        # Contexts from state down to the empty context, w/ sum of backoff weights before each
+        context, acc = [], np.zeros(len(state), dtype=np.float32)
+        node = np.asarray(state)
+        while (node > 0).any():
+            context.append((node, acc))
+            acc = acc + self.backoff[node]
+            node = self.suffix[node]
+        # Unigram backed off from all contexts, then overwritten by children of longer contexts
+        output = acc[:, None] + self.unigram
+        for node, acc in reversed(context):
+            start, n_child = self.child_start[node], self.child_end[node] - self.child_start[node]
+            n_child[node == 0] = 0
+            row = np.repeat(np.arange(len(node)), n_child)
+            child = np.arange(n_child.sum()) - np.repeat(np.cumsum(n_child) - n_child - start, n_child)
+            output[row, self.token[child]] = acc[row] + self.logp[child]
+        return output
+
+    def save(self, path):
+        ''' Binary serialisation (npz) '''
+        np.savez(path, vocab_size=self.vocab_size, order=self.order, token=self.token, parent=self.parent,
+                 suffix=self.suffix, logp=self.logp, backoff=self.backoff, unk_logp=self.unk_logp)
+
+    @classmethod
+    def load(cls, path):
+        ''' Load binary n-gram LM saved by save() '''
+        data = np.load(path)
+        return cls(int(data['vocab_size']), int(data['order']), data['token'], data['parent'], data['suffix'],
+                   data['logp'], data['backoff'], float(data['unk_logp']))
+
+    @classmethod
+    def from_arpa(cls, arpa_file, tokenizer):
+        ''' Read ARPA file w/ units of tokenizer (see token_units), n-grams w/ unknown units are dropped '''
+        unit2idx = {u: idx for idx, u in enumerate(token_units(tokenizer))}
+        ngram = {(): (0.0, 0.0)}  # Token ids -> (log10 prob, log10 backoff)
+        order, n = 0, 0
+        unk_logp = -99.0 * LOG10
+        with codecs.open(arpa_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('\\') and line.endswith('-grams:'):
+                    n = int(line[1:-len('-grams:')])
+                    order = max(order, n)
+                    continue
+                if n == 0 or len(line) == 0 or line.startswith('\\'):
+                    continue
+                field = line.split()
+                if field[1:n + 1] == ['<unk>']:
+                    unk_logp = float(field[0]) * LOG10
+                if any(u not in unit2idx for u in field[1:n + 1]):
+                    continue
+                ngram[tuple(unit2idx[u] for u in field[1:n + 1])] = \
+                    (float(field[0]), float(field[n + 1]) if len(field) > n + 1 else 0.0)
+        assert order > 0, 'No n-gram found in {}'.format(arpa_file)
+
+        # Nodes sorted by (order, parent, token)
+        node_id = {(): 0}
+        for n in range(1, order + 1):
+            level = sorted((node_id[k[:-1]], k[-1], k) for k in ngram if len(k) == n and k[:-1] in node_id)
+            for _, _, k in level:
+                node_id[k] = len(node_id)
+        keys = sorted(node_id, key=node_id.get)
+
+        def suffix_of(k):
+            k = k[1:]
+            while k not in node_id:
+                k = k[1:]
+            return node_id[k]
+
+        token = np.array([k[-1] if k else 0 for k in keys], dtype=np.int32)
+        parent = np.array([node_id[k[:-1]] if k else -1 for k in keys], dtype=np.int32)
+        suffix = np.array([suffix_of(k) if k else 0 for k in keys], dtype=np.int32)
+        logp = np.array([ngram[k][0] for k in keys], dtype=np.float32) * LOG10
+        backoff = np.array([ngram[k][1] for k in keys], dtype=np.float32) * LOG10
+        return cls(tokenizer.vocab_size, order, token, parent, suffix, logp, backoff, unk_logp)
+
+
+def load_ngram(path):
+    ''' Load binary n-gram LM (ARPA files are converted w/ build_ngram.py) '''
+    return NgramLM.load(path)
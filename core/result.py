@@ -0,0 +1,124 @@
+#! python
+# -*- coding: utf-8 -*-
+# Author: kun
+# @Time: 2019-10-29 20:39
+
+import os
+import csv
+import ast
+import glob
+
+# Output formats, parquet needs pyarrow
+RESULT_FORMATS = ['tsv', 'csv', 'parquet']
+# Num. of rows buffered before written out (one parquet part file per flush)
+RESULT_FLUSH_ROWS = 256
+
+
+class ResultWriter(object):
+    ''' Buffered writer of result rows (decoding/classification outputs), one row per utterance.
+        tsv/csv : a single text file kept open, parquet : a directory of part files.
+        w/ resume, rows of an existing output are kept and their keys (1st column) are in self.written '''
+
+    def __init__(self, path, columns, fmt='tsv', resume=False, flush_rows=RESULT_FLUSH_ROWS):
+        assert fmt in RESULT_FORMATS, 'Unknown result format {}, should be one of {}'.format(fmt, RESULT_FORMATS)
+        self.path = path
+        self.columns = list(columns)
+        self.fmt = fmt
+        self.flush_rows = flush_rows
+        self.buffer = []
+        self.written = set()
+        if fmt == 'parquet':
+            import pyarrow  # noqa: F401, fail early if not installed
+            if resume:
+                self.written = set(self._read_parquet()[self.columns[0]])
+            else:
+                for part in glob.glob(os.path.join(path, 'part-*.parquet')):
+                    os.remove(part)
+            os.makedirs(path, exist_ok=True)
+            self.n_part = len(glob.glob(os.path.join(path, 'part-*.parquet')))
+        else:
+            self.delimiter = '\t' if fmt == 'tsv' else ','
+            if resume and os.path.exists(path) and self._resume_text(self.delimiter):
+                self.file = open(path, 'a', newline='', encoding='utf-8')
+                self.writer = csv.writer(self.file, delimiter=self.delimiter, lineterminator='\n')
+            else:
+                self.file = open(path, 'w', newline='', encoding='utf-8')
+                self.writer = csv.writer(self.file, delimiter=self.delimiter, lineterminator='\n')
+                self.writer.writerow(self.columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, rows):
+        ''' Add rows (sequences of values in order of columns), rows added together are flushed together '''
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        if self.fmt == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pydict({c: [row[i] for row in self.buffer] for i, c in enumerate(self.columns)})
+            part_file = os.path.join(self.path, 'part-{:05d}.parquet'.format(self.n_part))
+            pq.write_table(table, part_file + '.tmp')
+            os.replace(part_file + '.tmp', part_file)
+            self.n_part += 1
+        else:
+            self.writer.writerows(self.buffer)
+            self.file.flush()
+        self.written.update(row[0] for row in self.buffer)
+        self.buffer = []
+
+    def read(self):
+        ''' Rows written so far (incl. resumed ones) in order, as lists of values in order of columns.
+            Text outputs store values as str, so values except keys are parsed back if they are literals '''
+        self.flush()
+        if self.fmt == 'parquet':
+            table = self._read_parquet()
+            return [list(row) for row in zip(*[table[c] for c in self.columns])]
+        with open(self.path, newline='', encoding='utf-8') as f:
+            rows = list(csv.reader(f, delimiter=self.delimiter))[1:]
+        return [[row[0]] + [_parse_literal(v) for v in row[1:]] for row in rows]
+
+    def close(self):
+        self.flush()
+        if self.fmt != 'parquet':
+            self.file.close()
+
+    def _resume_text(self, delimiter):
+        ''' Keys of rows in existing text output, the last group of rows (same key) may be cut off if
+            interrupted while writing, so it is dropped. Returns False if there is no header to resume from '''
+        with open(self.path, 'rb+') as f:
+            if not f.readline().endswith(b'\n'):
+                return False
+            last_key, group_start = None, f.tell()
+            for line in iter(f.readline, b''):
+                if not line.endswith(b'\n'):
+                    break
+                key = line.split(delimiter.encode(), 1)[0].decode('utf-8')
+                if key != last_key:
+                    if last_key is not None:
+                        self.written.add(last_key)
+                    last_key, group_start = key, f.tell() - len(line)
+            f.truncate(group_start)
+        return True
+
+    def _read_parquet(self):
+        import pyarrow.parquet as pq
+        parts = sorted(glob.glob(os.path.join(self.path, 'part-*.parquet')))
+        if len(parts) == 0:
+            return {c: [] for c in self.columns}
+        return pq.ParquetDataset(parts).read().to_pydict()
+
+
+def _parse_literal(value):
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
@@ -13,6 +13,7 @@ from torch.utils.tensorboard import SummaryWriter
 
 from core.option import default_hparas
 from core.util import human_format, Timer
+from core import tap
 
 
 class BaseSolver(object):
@@ -80,6 +81,11 @@ class BaseSolver(object):
             self.verbose('Evaluating result of tr. ckpt @ {}'.format(
                 config['core']['ckpt']))
 
+        # Tensor taps, disabled unless the config has a tap block
+        tensor_tap = tap.configure(**config.get('tap', {}))
+        if len(tensor_tap.taps) > 0:
+            self.verbose(tensor_tap.create_msg())
+
     def backward(self, loss):
         """
         Standard backward step with self.timer and debugger
@@ -0,0 +1,118 @@
+#! python
+# -*- coding: utf-8 -*-
+# Author: kun
+# @Time: 2019-10-29 20:39
+
+import os
+import glob
+import atexit
+import numpy as np
+import torch
+
+# Taps of intermediate tensors, in ASR.forward (train_*) and BeamDecoder.forward
+TAP_NAMES = ['train_feature', 'train_encoder', 'train_attention', 'feature', 'encoder', 'attention']
+# Records are written here, one sub-directory per tap
+TAP_DIR = 'tensor_out'
+# Num. of records per .npz chunk
+TAP_CHUNK_SIZE = 64
+# Chunks kept per tap and process, the oldest chunk is overwritten after that (ring buffer)
+TAP_MAX_CHUNKS = 16
+
+
+class TensorTap(object):
+    ''' Samples intermediate tensors into compact binary records.
+        Off by default, each enabled tap records a sample_rate fraction of its calls (evenly spaced),
+        records are buffered and written as <out_dir>/<tap>/<pid>-<slot>.npz. '''
+
+    def __init__(self, taps=(), sample_rate=1.0, out_dir=TAP_DIR, chunk_size=TAP_CHUNK_SIZE,
+                 max_chunks=TAP_MAX_CHUNKS):
+        for name in taps:
+            assert name in TAP_NAMES, 'Unknown tap {}, should be one of {}'.format(name, TAP_NAMES)
+        assert 0 < sample_rate <= 1
+        self.taps = set(taps)
+        self.sample_rate = sample_rate
+        self.out_dir = out_dir
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.n_call = {name: 0 for name in self.taps}
+        self.n_chunk = {name: 0 for name in self.taps}
+        self.buffer = {name: [] for name in self.taps}
+
+    def __call__(self, name, **tensors):
+        ''' Record tensors (e.g. attn=..., context=...) if tap is enabled and this call is sampled '''
+        if name not in self.taps:
+            return
+        n = self.n_call[name]
+        self.n_call[name] = n + 1
+        if int((n + 1) * self.sample_rate) == int(n * self.sample_rate):
+            return
+        record = {k: v.detach().cpu().numpy() if torch.is_tensor(v) else np.asarray(v)
+                  for k, v in tensors.items()}
+        record['call'] = np.asarray(n)
+        self.buffer[name].append(record)
+        if len(self.buffer[name]) >= self.chunk_size:
+            self.flush(name)
+
+    def flush(self, name=None):
+        for name in ([name] if name is not None else self.taps):
+            if len(self.buffer[name]) == 0:
+                continue
+            tap_dir = os.path.join(self.out_dir, name)
+            os.makedirs(tap_dir, exist_ok=True)
+            chunk_file = os.path.join(tap_dir, '{}-{:04d}.npz'.format(
+                os.getpid(), self.n_chunk[name] % self.max_chunks))
+            tmp_file = chunk_file + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, **{'{}/{}'.format(i, k): v for i, record in enumerate(self.buffer[name])
+                               for k, v in record.items()})
+            os.replace(tmp_file, chunk_file)
+            self.n_chunk[name] += 1
+            self.buffer[name] = []
+
+    def create_msg(self):
+        return ['Tensor tap | Taps = {}\t| Sample rate = {}\t| Output = {}'.format(
+            sorted(self.taps), self.sample_rate, self.out_dir)]
+
+
+# Process-wide tap used by the models, disabled until configure() is called
+tap = TensorTap()
+
+
+def configure(**tap_config):
+    ''' Replace the process-wide tap, e.g. configure(taps=['encoder'], sample_rate=0.01) '''
+    global tap
+    tap.flush()
+    tap = TensorTap(**tap_config)
+    return tap
+
+
+def record(name, **tensors):
+    tap(name, **tensors)
+
+
+def flush():
+    ''' Write buffered records, needed before exiting a process w/o atexit (e.g. forked worker) '''
+    tap.flush()
+
+
+@atexit.register
+def _flush_at_exit():
+    tap.flush()
+
+
+def load_tap(name, out_dir=TAP_DIR):
+    ''' Read all records of a tap (for analysis notebooks).
+        Returns a list of dicts {field: np.ndarray, 'call': index of the call}, ordered by process and call '''
+    records = []
+    for chunk_file in glob.glob(os.path.join(out_dir, name, '*.npz')):
+        pid = int(os.path.basename(chunk_file).split('-')[0])
+        with np.load(chunk_file) as chunk:
+            chunk_records = {}
+            for key in chunk.files:
+                i, k = key.split('/', 1)
+                chunk_records.setdefault(int(i), {})[k] = chunk[key]
+        for i in sorted(chunk_records):
+            chunk_records[i]['pid'] = pid
+            records.append(chunk_records[i])
+    records.sort(key=lambda r: (r['pid'], int(r['call'])))
+    return records
@@ -15,6 +15,9 @@ BERT_LAST_IDX = 29635  # Drop rest of tokens
 
 
 class _BaseTextEncoder(abc.ABC):
+    # File the vocab is loaded from, set by load_text_encoder
+    vocab_file = None
+
     @abc.abstractmethod
     def encode(self, s):
         raise NotImplementedError
@@ -233,12 +236,15 @@ class BertTextEncoder(_BaseTextEncoder):
 def load_text_encoder(mode, vocab_file):
     if mode == "character":
         print("Load text encoder : CharacterTextEncoder")
-        return CharacterTextEncoder.load_from_file(vocab_file)
+        tokenizer = CharacterTextEncoder.load_from_file(vocab_file)
     elif mode == "subword":
-        return SubwordTextEncoder.load_from_file(vocab_file)
+        tokenizer = SubwordTextEncoder.load_from_file(vocab_file)
     elif mode == "word":
-        return WordTextEncoder.load_from_file(vocab_file)
+        tokenizer = WordTextEncoder.load_from_file(vocab_file)
     elif mode.startswith("bert-"):
-        return BertTextEncoder.load_from_file(mode)
+        tokenizer = BertTextEncoder.load_from_file(mode)
+        vocab_file = mode
     else:
         raise NotImplementedError("`{}` is not yet supported.".format(mode))
+    tokenizer.vocab_file = vocab_file
+    return tokenizer
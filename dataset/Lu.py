@@ -10,49 +10,26 @@ from os.path import join, getsize
 from joblib import Parallel, delayed
 from torch.utils.data import Dataset
 
+from dataset.duration import probe_duration
+from dataset.manifest import Manifest
+from dataset.transcript import load_transcript
+
 # Additional (official) text core provided
 OFFICIAL_TXT_SRC = ['LutranscriptForLM.txt']
 # Remove longest N sentence in librispeech-lm-norm.txt
 REMOVE_TOP_N_TXT = 5000000
 # Default num. of threads used for loading LibriSpeech
 READ_FILE_THREADS = 10
+# Transcript of all wave files
+# TRANSCRIPT_FILE = "/data/Speech/SLR33/data_aishell/" + "transcript/aishell_transcript_v0.8.txt"
+TRANSCRIPT_FILE = "/mnt/usb/jason3/cv-corpus-11.0-2022-09-21/zh-TW/cv11transcriptLu.txt"
 
 
 def read_text(file):
-    '''Get transcription of target wave file,
-       it's somewhat redundant for accessing each txt multiplt times,
-       but it works fine with multi-thread'''
-    # print("read_text: file {}".format(file))
-    # src_file = "/data/Speech/SLR33/data_aishell/" + "transcript/aishell_transcript_v0.8.txt"
-    src_file = "/mnt/usb/jason3/cv-corpus-11.0-2022-09-21/zh-TW/cv11transcriptLu.txt"
+    '''Get transcription of target wave file from the transcript index'''
     idx = file.split('/')[-1].split('.')[0]
-    # print(idx)
-
-    with open(src_file, 'r') as fp:
-        for line in fp:
-            # print(line.split(' ')[0])
-            if idx == line.split(' ')[0]:
-                line = line.strip('\n')
-                aishell_word_list = line.split(' ')
-                # print("aishell_word_list: ", aishell_word_list)
-                new_list = []
-                for word in aishell_word_list[1:]:  # 去除idx
-                    if word != ' ' and word != '':
-                        if len(word) == 1:
-                            new_list.append(word)
-                        else:
-                            for char in word:
-                                new_list.append(char)
-
-                # print("new_list: ", new_list)
-                new_line = ' '.join(new_list).strip(' ')
-                # print("new_line: ", new_line)
-                char_list = [c for c in new_line.split(' ')]
-                # print("char_list: ", char_list)
-                trans_text = "".join(char_list)
-                return trans_text, file
-
-    return None, file
+
+    return load_transcript(TRANSCRIPT_FILE).get(idx), file
 
 
 class LuDataset(Dataset):
@@ -62,37 +39,43 @@ class LuDataset(Dataset):
         self.path = path
         self.bucket_size = bucket_size
 
-        # List all wave files
-        file_list = []
-        for s in split:
-            split_path = Path(join(path, s))
-            split_list = list(split_path.rglob("*.wav"))
-            assert len(split_list) > 0, "No data found @ {}".format(path)
-            print("LuDataset {} found wav data: {}".format(s, len(split_list)))
-            file_list += split_list
+        # Reuse file list & text of last run if nothing changed
+        manifest = Manifest('Lu', path, split, sources=[TRANSCRIPT_FILE], tokenizer=tokenizer)
+        content = manifest.load()
+        if content is None:
+            # List all wave files
+            file_list = []
+            for s in split:
+                split_path = Path(join(path, s))
+                split_list = list(split_path.rglob("*.wav"))
+                assert len(split_list) > 0, "No data found @ {}".format(path)
+                print("LuDataset {} found wav data: {}".format(s, len(split_list)))
+                file_list += split_list
+
+            # Read text
+            text = [read_text(str(f)) for f in file_list]
+            print("text len: {}".format(len(text)))
+            # text = Parallel(n_jobs=-1)(delayed(tokenizer.encode)(txt) for txt in text)
+            new_text = []
+            new_file_list = []
+            for t, f in text:
+                if t is not None:
+                    new_text.append(t)
+                    new_file_list.append(f)
+            print("remove None, then wav data: {}, text len: {}".format(len(new_file_list), len(new_text)))
+
+            text = [tokenizer.encode(txt) for txt in new_text]
+
+            # Read audio duration from header
+            audio_dur = probe_duration(new_file_list, READ_FILE_THREADS)
+            manifest.save(file_list=new_file_list, text=text, audio_dur=audio_dur)
+        else:
+            new_file_list, text, audio_dur = content['file_list'], content['text'], content['audio_dur']
+            print("LuDataset {} wav data from manifest: {}".format(split, len(new_file_list)))
 
-        # Read text
-        text = Parallel(n_jobs=READ_FILE_THREADS)(
-            delayed(read_text)(str(f)) for f in file_list)
-        # text = []
-        # for f in file_list:
-        #     text.append(read_text(str(f)))
-        print("text len: {}".format(len(text)))
-        # text = Parallel(n_jobs=-1)(delayed(tokenizer.encode)(txt) for txt in text)
-        new_text = []
-        new_file_list = []
-        for t, f in text:
-            if t is not None:
-                new_text.append(t)
-                new_file_list.append(f)
-        print("remove None, then wav data: {}, text len: {}".format(len(new_file_list), len(new_text)))
-
-        text = [tokenizer.encode(txt) for txt in new_text]
-
-        # Sort dataset by text length
-        # file_len = Parallel(n_jobs=READ_FILE_THREADS)(delayed(getsize)(f) for f in file_list)
-        self.file_list, self.text = zip(*[(f_name, txt)
-                                          for f_name, txt in sorted(zip(new_file_list, text), reverse=not ascending, key=lambda x: len(x[1]))])
+        # Sort dataset by audio duration
+        self.file_list, self.text, self.audio_dur = zip(*sorted(zip(new_file_list, text, audio_dur),
+                                                                reverse=not ascending, key=lambda x: x[2]))
 
     def __getitem__(self, index):
         # print("[AishellDataset  __getitem__] index: {}".format(index))
@@ -128,8 +111,7 @@ class LuTextDataset(Dataset):
         assert (len(file_list) > 0) or (len(all_sent) > 0), "No data found @ {}".format(path)
 
         # Read text
-        text = Parallel(n_jobs=READ_FILE_THREADS)(
-            delayed(read_text)(str(f)) for f in file_list)
+        text = [read_text(str(f)) for f in file_list]
         all_sent.extend(text)
         del text
 
@@ -0,0 +1,19 @@
+#! python
+# -*- coding: utf-8 -*-
+# Author: kun
+# @Time: 2019-10-30 14:40
+
+import soundfile as sf
+from joblib import Parallel, delayed
+
+
+def read_duration(file):
+    '''Duration (sec.) of an audio file, only the header (WAV/FLAC) is read'''
+    info = sf.info(str(file))
+    return info.frames / info.samplerate
+
+
+def probe_duration(file_list, n_jobs):
+    '''Durations of all files, probed by threads since it is I/O bound'''
+    return Parallel(n_jobs=n_jobs, prefer='threads', batch_size=256)(
+        delayed(read_duration)(f) for f in file_list)
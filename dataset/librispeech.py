@@ -9,6 +9,10 @@ from os.path import join, getsize
 from joblib import Parallel, delayed
 from torch.utils.data import Dataset
 
+from dataset.duration import probe_duration
+from dataset.manifest import Manifest
+from dataset.transcript import load_transcript, parse_raw_line
+
 # Additional (official) text core provided
 OFFICIAL_TXT_SRC = ['librispeech-lm-norm.txt']
 # Remove longest N sentence in librispeech-lm-norm.txt
@@ -18,16 +22,12 @@ READ_FILE_THREADS = 4
 
 
 def read_text(file):
-    '''Get transcription of target wave file,
-       it's somewhat redundant for accessing each txt multiplt times,
-       but it works fine with multi-thread'''
+    '''Get transcription of target wave file from the transcript index of its chapter'''
     src_file = '-'.join(file.split('-')[:-1]) + '.trans.txt'
     idx = file.split('/')[-1].split('.')[0]
 
-    with open(src_file, 'r') as fp:
-        for line in fp:
-            if idx == line.split(' ')[0]:
-                return line[:-1].split(' ', 1)[1]
+    # Chapter transcripts are small, no need to keep a binary index of each
+    return load_transcript(src_file, parser=parse_raw_line, persist=False).get(idx)
 
 
 class LibriDataset(Dataset):
@@ -36,23 +36,33 @@ class LibriDataset(Dataset):
         self.path = path
         self.bucket_size = bucket_size
 
-        # List all wave files
-        file_list = []
-        for s in split:
-            split_list = list(Path(join(path, s)).rglob("*.flac"))
-            assert len(split_list) > 0, "No data found @ {}".format(join(path, s))
-            file_list += split_list
-
-        # Read text
-        text = Parallel(n_jobs=READ_FILE_THREADS)(
-            delayed(read_text)(str(f)) for f in file_list)
-        # text = Parallel(n_jobs=-1)(delayed(tokenizer.encode)(txt) for txt in text)
-        text = [tokenizer.encode(txt) for txt in text]
+        # Reuse file list & text of last run if nothing changed
+        # (chapter transcripts are checked as sources, editing one doesn't touch its directory)
+        trans_files = sorted(str(f) for s in split for f in Path(join(path, s)).glob("*/*/*.trans.txt"))
+        manifest = Manifest('librispeech', path, split, sources=trans_files, tokenizer=tokenizer)
+        content = manifest.load()
+        if content is None:
+            # List all wave files
+            file_list = []
+            for s in split:
+                split_list = list(Path(join(path, s)).rglob("*.flac"))
+                assert len(split_list) > 0, "No data found @ {}".format(join(path, s))
+                file_list += split_list
+
+            # Read text
+            text = [read_text(str(f)) for f in file_list]
+            # text = Parallel(n_jobs=-1)(delayed(tokenizer.encode)(txt) for txt in text)
+            text = [tokenizer.encode(txt) for txt in text]
+
+            # Read audio duration from header
+            audio_dur = probe_duration(file_list, READ_FILE_THREADS)
+            manifest.save(file_list=file_list, text=text, audio_dur=audio_dur)
+        else:
+            file_list, text, audio_dur = content['file_list'], content['text'], content['audio_dur']
 
-        # Sort dataset by text length
-        # file_len = Parallel(n_jobs=READ_FILE_THREADS)(delayed(getsize)(f) for f in file_list)
-        self.file_list, self.text = zip(*[(f_name, txt)
-                                          for f_name, txt in sorted(zip(file_list, text), reverse=not ascending, key=lambda x: len(x[1]))])
+        # Sort dataset by audio duration
+        self.file_list, self.text, self.audio_dur = zip(*sorted(zip(file_list, text, audio_dur),
+                                                                reverse=not ascending, key=lambda x: x[2]))
 
     def __getitem__(self, index):
         if self.bucket_size > 1:
@@ -88,8 +98,7 @@ class LibriTextDataset(Dataset):
                                         > 0), "No data found @ {}".format(path)
 
         # Read text
-        text = Parallel(n_jobs=READ_FILE_THREADS)(
-            delayed(read_text)(str(f)) for f in file_list)
+        text = [read_text(str(f)) for f in file_list]
         all_sent.extend(text)
         del text
 
@@ -0,0 +1,78 @@
+#! python
+# -*- coding: utf-8 -*-
+# Author: kun
+# @Time: 2019-10-30 14:40
+
+import os
+import pickle
+import hashlib
+from os.path import join
+
+# Cached dataset manifests are stored here
+MANIFEST_DIR = 'cache/manifest'
+# Bump when the content of manifest changes
+MANIFEST_VERSION = 2
+# Depth of sub-directories checked for modification under each split
+SPLIT_SIGN_DEPTH = 2
+
+
+class Manifest(object):
+    '''Cache of everything a dataset builds before sorting (file list, labels, token ids, durations),
+       reused as long as the split directories, transcript files and vocab are unchanged.
+       Note: only directories up to SPLIT_SIGN_DEPTH levels below each split are checked,
+             wav files replaced in place without touching their directory are not detected.'''
+
+    def __init__(self, name, path, split, sources=(), tokenizer=None):
+        sign = [MANIFEST_VERSION, name, os.path.abspath(path), list(split)]
+        for s in split:
+            sign.append(_dir_sign(join(path, s), SPLIT_SIGN_DEPTH))
+        for src in sources:
+            sign.append(_file_sign(src))
+        if tokenizer is not None:
+            sign.append(tokenizer.token_type)
+            sign.append(_file_sign(tokenizer.vocab_file) if tokenizer.vocab_file is not None
+                        and os.path.isfile(tokenizer.vocab_file) else tokenizer.vocab_file)
+        self.sign = sign
+        self.manifest_file = join(MANIFEST_DIR, '{}-{}.pkl'.format(
+            name, hashlib.sha1(repr(sign[:4]).encode('utf-8')).hexdigest()[:16]))
+
+    def load(self):
+        ''' Return cached content (dict) or None if missing/outdated '''
+        if not os.path.exists(self.manifest_file):
+            return None
+        with open(self.manifest_file, 'rb') as f:
+            manifest = pickle.load(f)
+        if manifest['sign'] != self.sign:
+            return None
+        print("Load manifest from {}".format(self.manifest_file))
+        return manifest['content']
+
+    def save(self, **content):
+        try:
+            os.makedirs(MANIFEST_DIR, exist_ok=True)
+            tmp_file = '{}.{}.tmp'.format(self.manifest_file, os.getpid())
+            with open(tmp_file, 'wb') as f:
+                pickle.dump({'sign': self.sign, 'content': content}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, self.manifest_file)
+        except OSError:
+            # Manifest is only a speedup for the next run
+            pass
+
+
+def _file_sign(file):
+    if not os.path.isfile(file):
+        return (file, None)
+    stat = os.stat(file)
+    return (file, stat.st_mtime_ns, stat.st_size)
+
+
+def _dir_sign(root, depth):
+    if not os.path.isdir(root):
+        return [(root, None)]
+    sign = [(root, os.stat(root).st_mtime_ns)]
+    if depth > 0:
+        with os.scandir(root) as it:
+            for entry in sorted(it, key=lambda e: e.name):
+                if entry.is_dir():
+                    sign += _dir_sign(entry.path, depth - 1)
+    return sign
@@ -0,0 +1,73 @@
+#! python
+# -*- coding: utf-8 -*-
+# Author: kun
+# @Time: 2019-10-30 14:40
+
+import os
+import pickle
+import hashlib
+
+# Binary copies of parsed transcripts are stored here
+INDEX_DIR = 'cache/transcript'
+# Bump when the on-disk index format changes
+INDEX_VERSION = 1
+
+# Parsed transcripts of current process, {(src_file, parser): {idx: text}}
+_loaded = {}
+
+
+def parse_char_line(line):
+    '''Split "<idx> <w1> <w2> ..." into idx and transcription with all spaces removed'''
+    idx = line.split(' ')[0]
+    words = line.strip('\n').split(' ')
+    return idx, ''.join(words[1:])
+
+
+def parse_raw_line(line):
+    '''Split "<idx> <transcription>" into idx and transcription (kept as is)'''
+    words = line.rstrip('\n').split(' ', 1)
+    return words[0], words[1] if len(words) > 1 else ''
+
+
+def load_transcript(src_file, parser=parse_char_line, persist=True):
+    '''Get {idx: transcription} of a transcript file.
+       Each file is parsed once per process, and optionally once per modification
+       through a binary index stored under INDEX_DIR.
+       Only the first line of duplicated idx is kept, as the former linear scan did.'''
+    key = (src_file, parser.__name__)
+    if key not in _loaded:
+        _loaded[key] = _load_index(src_file, parser, persist)
+    return _loaded[key]
+
+
+def _load_index(src_file, parser, persist):
+    stat = os.stat(src_file)
+    sign = (INDEX_VERSION, parser.__name__, stat.st_mtime_ns, stat.st_size)
+    index_file = os.path.join(INDEX_DIR, '{}-{}.idx'.format(
+        os.path.basename(src_file),
+        hashlib.sha1(os.path.abspath(src_file).encode('utf-8')).hexdigest()[:8]))
+
+    if persist and os.path.exists(index_file):
+        with open(index_file, 'rb') as f:
+            index = pickle.load(f)
+        if index['sign'] == sign:
+            return index['table']
+
+    table = {}
+    with open(src_file, 'r') as fp:
+        for line in fp:
+            idx, text = parser(line)
+            if idx not in table:
+                table[idx] = text
+
+    if persist:
+        try:
+            os.makedirs(INDEX_DIR, exist_ok=True)
+            tmp_file = '{}.{}.tmp'.format(index_file, os.getpid())
+            with open(tmp_file, 'wb') as f:
+                pickle.dump({'sign': sign, 'table': table}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, index_file)
+        except OSError:
+            # Index is only a speedup for the next run
+            pass
+    return table
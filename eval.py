@@ -3,6 +3,7 @@
 # Author: kun
 # @Time: 2019-10-29 20:30
 
+import os
 import argparse
 import numpy as np
 import pandas as pd
@@ -13,7 +14,7 @@ SEP = ' '
 # Arguments
 parser = argparse.ArgumentParser(
     description='Script for evaluating recognition results.')
-parser.add_argument('--file', type=str, help='Path to result csv.')
+parser.add_argument('--file', type=str, help='Path to result csv (tab or comma separated) or parquet directory.')
 paras = parser.parse_args()
 
 
@@ -29,7 +30,13 @@ def cal_wer(row):
 
 
 # Evaluation
-result = pd.read_csv(paras.file, sep='\t')
+if os.path.isdir(paras.file):
+    result = pd.read_parquet(paras.file)
+else:
+    # --result-format tsv/csv are both written as .csv, delimiter is told from the header
+    with open(paras.file, encoding='utf-8') as f:
+        header = f.readline()
+    result = pd.read_csv(paras.file, sep='\t' if '\t' in header else ',')
 result['hyp_char_cnt'] = result.apply(lambda x: len(x.hyp), axis=1)
 result['hyp_word_cnt'] = result.apply(lambda x: len(x.hyp.split(SEP)), axis=1)
 result['truth_char_cnt'] = result.apply(lambda x: len(x.truth), axis=1)
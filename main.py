@@ -38,6 +38,9 @@ parser.add_argument('--cudnn-ctc', action='store_true',
 parser.add_argument('--njobs', default=32, type=int,
                     help='Number of threads for dataloader/decoding.', required=False)
 parser.add_argument('--cpu', action='store_true', help='Disable GPU training.')
+parser.add_argument('--result-format', default='tsv', choices=['tsv', 'csv', 'parquet'],
+                    help='Format of test outputs, parquet needs pyarrow.', required=False)
+parser.add_argument('--resume', action='store_true', help='Resume partially written test outputs.')
 parser.add_argument('--no-pin', action='store_true',
                     help='Disable pin-memory for dataloader')
 parser.add_argument('--test', action='store_true', help='Test the model.')
@@ -3,16 +3,25 @@
 # Author: kun
 # @Time: 2019-10-29 20:44
 
-import copy
+from functools import partial
+import queue
+import traceback
+
+import numpy as np
 import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
-from functools import partial
-from joblib import Parallel, delayed
 
 from core.solver import BaseSolver
 from core.asr import ASR
-from core.decode import BeamDecoder
+from core.decode import BeamDecoder, CTCDecoder
 from core.data import load_dataset
+from core.result import ResultWriter
+from core import tap
+
+# Seconds waiting for a decoded batch before checking decoding workers are alive
+POLL_TIMEOUT = 5
 
 activation = {}
 def get_activation(name):
@@ -38,16 +47,17 @@ class Solver(BaseSolver):
         self.config['data']['text'] = self.src_config['data']['text']
         self.config['model'] = self.src_config['model']
 
-        # Output file
-        self.output_file = str(self.ckpdir) + '_{}_{}.csv'
+        # Output file (tsv as .csv, or parquet), partially written outputs are resumed w/ --resume
+        self.result_format = getattr(self.paras, 'result_format', 'tsv')
+        self.resume = getattr(self.paras, 'resume', False)
+        self.output_file = str(self.ckpdir) + '_{}_{}' + ('.parquet' if self.result_format == 'parquet' else '.csv')
 
-        # Override batch size for beam decoding
+        # Decoding runs on batches of data.corpus.batch_size utterances, beam_size = 1 for greedy decoding
         self.greedy = self.config['decode']['beam_size'] == 1
-        if not self.greedy:
-            self.config['data']['corpus']['batch_size'] = 1
-        else:
-            # ToDo : implement greedy
-            raise NotImplementedError
+        # 'attention' : attention decoder (w/ joint CTC/LM if set), 'ctc' : CTC only (default for CTC-only models)
+        self.decode_mode = self.config['decode'].pop(
+            'mode', 'ctc' if self.config['model']['ctc_weight'] == 1 else 'attention')
+        assert self.decode_mode in ['attention', 'ctc'], 'Unsupported decode mode: ' + self.decode_mode
 
     def load_data(self):
         ''' Load data for training/validation, store tokenizer and input/output shape'''
@@ -75,20 +85,60 @@ class Solver(BaseSolver):
         # Load target model in eval mode
         self.load_ckpt()
 
-        # Beam decoder
-        self.decoder = BeamDecoder(
-            self.model.cpu(), self.emb_decoder, **self.config['decode'])
-        self.verbose(self.decoder.create_msg())
-        del self.model
-        del self.emb_decoder
+        if self.decode_mode == 'ctc':
+            # CTC decoder, best path if greedy
+            lm_config = {k: v for k, v in self.config['decode'].items() if k in ['lm_path', 'lm_config', 'lm_weight']}
+            self.decoder = CTCDecoder(
+                self.model, self.config['decode']['beam_size'], **lm_config).to(self.device)
+            self.verbose(self.decoder.create_msg())
+            del self.model
+            del self.emb_decoder
+        elif self.greedy:
+            # Greedy attention decoder
+            self.model = self.model.to(self.device)
+            if self.emb_decoder is not None:
+                self.emb_decoder = self.emb_decoder.to(self.device)
+            self.verbose('Decode spec| Greedy attention decoding w/ max len. ratio = {}'.format(
+                self.config['decode']['max_len_ratio']))
+        else:
+            # Beam decoder
+            self.decoder = BeamDecoder(
+                self.model, self.emb_decoder, **self.config['decode']).to(self.device)
+            self.verbose(self.decoder.create_msg())
+            del self.model
+            del self.emb_decoder
 
     def exec(self):
         ''' Testing End-to-end ASR system '''
+        # Decode fn. of a batch
+        if self.decode_mode == 'attention' and self.greedy:
+            decode_fn = partial(greedy_decode, model=self.model, emb_decoder=self.emb_decoder,
+                                max_len_ratio=self.config['decode']['max_len_ratio'], device=self.device)
+        else:
+            decode_fn = partial(beam_decode, model=self.decoder, device=self.device)
+        # Worker processes on CPU (njobs), in-process otherwise
+        if self.device.type == 'cpu' and self.paras.njobs > 1:
+            pool = DecodePool(decode_fn, self.paras.njobs)
+            self.verbose('Decoding w/ {} worker processes, {} thread(s) each.'.format(
+                pool.n_workers, pool.n_threads))
+        else:
+            pool = None
+
         for s, ds in zip(['dev', 'test'], [self.dv_set, self.tt_set]):
             # Setup output
             self.cur_output_path = self.output_file.format(s, 'output')
-            with open(self.cur_output_path, 'w') as f:
-                f.write('idx\thyp\ttruth\n')
+            best_writer = ResultWriter(self.cur_output_path, ['idx', 'hyp', 'truth'], self.result_format, self.resume)
+            beam_writer = None
+            if not self.greedy:
+                # Additional output to store all beams
+                self.cur_beam_path = self.output_file.format(s, 'beam')
+                beam_writer = ResultWriter(self.cur_beam_path, ['idx', 'beam', 'hyp', 'truth'],
+                                           self.result_format, self.resume)
+            # Skip utterances already written (before their features are extracted)
+            written = best_writer.written if self.greedy else best_writer.written & beam_writer.written
+            if len(written) > 0:
+                self.verbose('Resuming {} set, {} utterances already decoded.'.format(s, len(written)))
+                ds = self.remaining(ds, written)
 
             if self.greedy:
                 # Greedy decode
@@ -97,50 +147,143 @@ class Solver(BaseSolver):
                 self.verbose('Results will be stored at {}'.format(
                     self.cur_output_path))
             else:
-                # Additional output to store all beams
-                self.cur_beam_path = self.output_file.format(s, 'beam')
-                with open(self.cur_beam_path, 'w') as f:
-                    f.write('idx\tbeam\thyp\ttruth\n')
                 self.verbose(
-                    'Performing instance-wise beam decoding on {} set. (NOTE: use --njobs to speedup)'.format(s))
-                # Minimal function to pickle
-                beam_decode_func = partial(beam_decode, model=copy.deepcopy(
-                    self.decoder), device=self.device)
-                # Parallel beam decode
-                results = Parallel(n_jobs=self.paras.njobs)(
-                    delayed(beam_decode_func)(data) for data in tqdm(ds))
+                    'Performing batch-wise beam decoding on {} set, num of batch = {}.'.format(s, len(ds)))
                 self.verbose(
                     'Results/Beams will be stored at {} / {}.'.format(self.cur_output_path, self.cur_beam_path))
-                self.write_hyp(results, self.cur_output_path,
-                               self.cur_beam_path)
+            # Results are written as batches finish
+            for results in tqdm(map(decode_fn, ds) if pool is None else pool.imap(ds), total=len(ds)):
+                self.write_hyp(results, best_writer, beam_writer)
+            best_writer.close()
+            if beam_writer is not None:
+                beam_writer.close()
+        if pool is not None:
+            pool.close()
         self.verbose('All done !')
 
-    def write_hyp(self, results, best_path, beam_path):
+    def remaining(self, loader, written):
+        ''' Loader over utterances of loader not in written, same batch size & collect function '''
+        index = [i for i, f in enumerate(loader.dataset.file_list)
+                 if str(f).split('/')[-1].split('.')[0] not in written]
+        return DataLoader(Subset(loader.dataset, index), batch_size=loader.batch_size, shuffle=False,
+                          drop_last=False, collate_fn=loader.collate_fn, num_workers=loader.num_workers,
+                          pin_memory=loader.pin_memory)
+
+    def write_hyp(self, results, best_writer, beam_writer):
         '''Record decoding results'''
-        for name, hyp_seqs, truth in tqdm(results):
+        for name, hyp_seqs, truth in results:
             hyp_seqs = [self.tokenizer.decode(hyp) for hyp in hyp_seqs]
             truth = self.tokenizer.decode(truth)
-            with open(best_path, 'a') as f:
-                f.write('\t'.join([name, hyp_seqs[0], truth]) + '\n')
-            if not self.greedy:
-                with open(beam_path, 'a') as f:
-                    for b, hyp in enumerate(hyp_seqs):
-                        f.write('\t'.join([name, str(b), hyp, truth]) + '\n')
+            if name not in best_writer.written:
+                best_writer.write([(name, hyp_seqs[0], truth)])
+            if beam_writer is not None and name not in beam_writer.written:
+                beam_writer.write([(name, b, hyp, truth) for b, hyp in enumerate(hyp_seqs)])
+
+
+class DecodePool(object):
+    ''' Decoding worker processes (forked), model weights are shared memory tensors.
+        Batches are sent through a task queue, results are returned in order of batches '''
+
+    def __init__(self, decode_fn, n_workers):
+        self.n_workers = n_workers
+        self.n_threads = max(1, torch.get_num_threads() // n_workers)
+        for m in decode_fn.keywords.values():
+            if isinstance(m, torch.nn.Module):
+                m.share_memory()
+        # Records buffered so far would be copied into (and written again by) each worker
+        tap.flush()
+        ctx = mp.get_context('fork')
+        self.task_queue, self.result_queue = ctx.Queue(), ctx.Queue()
+        self.workers = [ctx.Process(target=decode_worker,
+                                    args=(decode_fn, self.n_threads, self.task_queue, self.result_queue), daemon=True)
+                        for _ in range(n_workers)]
+        for w in self.workers:
+            w.start()
+
+    def imap(self, batches):
+        ''' Decode all batches, yields result of each batch in order '''
+        pending, n_sent, n_done = {}, 0, 0
+        for data in batches:
+            self.task_queue.put((n_sent, data))
+            n_sent += 1
+            # At most 2 batches in flight per worker
+            while n_sent - n_done >= 2 * self.n_workers:
+                n_done = yield from self._collect(pending, n_done)
+        while n_done < n_sent:
+            n_done = yield from self._collect(pending, n_done)
+
+    def _collect(self, pending, n_done):
+        while True:
+            try:
+                idx, ok, result = self.result_queue.get(timeout=POLL_TIMEOUT)
+                break
+            except queue.Empty:
+                # Workers only exit after close(), a dead one (e.g. OOM killed) never returns its batches
+                for w in self.workers:
+                    if not w.is_alive():
+                        self.terminate()
+                        raise RuntimeError('Decoding worker (pid {}) died w/ exit code {}.'.format(w.pid, w.exitcode))
+        if not ok:
+            self.terminate()
+            raise RuntimeError('Decoding worker failed on batch {}:\n{}'.format(idx, result))
+        pending[idx] = result
+        while n_done in pending:
+            yield pending.pop(n_done)
+            n_done += 1
+        return n_done
+
+    def close(self):
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for w in self.workers:
+            w.join()
+
+    def terminate(self):
+        for w in self.workers:
+            w.terminate()
+        for w in self.workers:
+            w.join()
+
+
+def decode_worker(decode_fn, n_threads, task_queue, result_queue):
+    ''' Puts (batch index, ok, result) for each batch, result is the traceback (str) if decoding failed '''
+    torch.set_num_threads(n_threads)
+    # Forked workers exit w/o atexit, buffered tap records are flushed here
+    try:
+        for idx, data in iter(task_queue.get, None):
+            try:
+                result_queue.put((idx, True, decode_fn(data)))
+            except Exception:
+                tap.flush()
+                result_queue.put((idx, False, traceback.format_exc()))
+    finally:
+        tap.flush()
 
 
 def beam_decode(data, model, device):
-    # Fetch data : move data/model to device
+    # Fetch data : move data to device
     name, feat, feat_len, txt = data
     feat = feat.to(device)
     feat_len = feat_len.to(device)
-    txt = txt.to(device)
-    txt_len = torch.sum(txt != 0, dim=-1)
-    model = model.to(device)
 #     model.encoder.register_forward_hook(get_activation('encoder'))
     # Decode
     with torch.no_grad():
         hyps = model(feat, feat_len)
 
-    hyp_seqs = [hyp.outIndex for hyp in hyps]
-    del hyps
-    return (name[0], hyp_seqs, txt[0].cpu().tolist())  # Note: bs == 1
+    return [(name[b], [seq for seq, _ in hyps[b]], txt[b].tolist()) for b in range(len(hyps))]
+
+
+def greedy_decode(data, model, emb_decoder, max_len_ratio, device):
+    # Fetch data : move data to device
+    name, feat, feat_len, txt = data
+    feat = feat.to(device)
+    feat_len = feat_len.to(device)
+    # Same max. output length as beam decoding, per utterance
+    max_output_len = np.ceil(feat_len.cpu().numpy() * max_len_ratio).astype(int)
+    # Decode
+    with torch.no_grad():
+        _, _, att_output, _, _ = model(feat, feat_len, int(max_output_len.max()),
+                                       emb_decoder=emb_decoder, stop_at_eos=True)
+
+    att_hyp = att_output.argmax(dim=-1).cpu()
+    return [(name[b], [att_hyp[b, :max_output_len[b]].tolist()], txt[b].tolist()) for b in range(len(name))]
@@ -8,8 +8,9 @@ from core.solver import BaseSolver
 
 from core.asr import ASR, Encoder_Classifier
 from core.optim import Optimizer
-from core.data import load_biclass_dataset
+from core.data import load_biclass_dataset, load_encoder_cache
 from core.util import human_format, cal_er, feat_to_fig
+from core.result import ResultWriter
 
 
 class Solver(BaseSolver):
@@ -21,6 +22,12 @@ class Solver(BaseSolver):
         self.best_wer = {'att': 3.0, 'ctc': 3.0}
         # Curriculum learning affects data loader
         self.curriculum = self.config['hparas']['curriculum']
+        # Test output (tsv as .csv, or parquet), partially written outputs are resumed w/ --resume
+        self.result_format = getattr(self.paras, 'result_format', 'tsv')
+        self.resume = getattr(self.paras, 'resume', False)
+        self.output_file = str(self.ckpdir) + '_output' + ('.parquet' if self.result_format == 'parquet' else '.csv')
+        # Train/test fc alone on stored output of the frozen encoder
+        self.encoder_cache = self.config['data'].get('encoder_cache')
         
 #     def load_my_state_dict(self, state_dict):
  
@@ -80,6 +87,12 @@ class Solver(BaseSolver):
 
         return feat, feat_len, txt, txt_len
 
+    def classify(self, feat, feat_len):
+        ''' Model output, feat is the stored encoder output if encoder cache is enabled '''
+        if self.encoder_cache is not None:
+            return self.model.head(feat[0])
+        return self.model(feat, feat_len)
+
     def load_data(self):
         print("Load data for training/validation, store tokenizer and input/output shape")
         self.dv_set, self.tt_set, self.feat_dim, msg = \
@@ -111,6 +124,10 @@ class Solver(BaseSolver):
 
         # Automatically load pre-trained model if self.paras.load is given
         self.load_ckpt()
+        if self.encoder_cache is not None:
+            self.dv_set, self.tt_set, msg = \
+                load_encoder_cache(self.dv_set, self.tt_set, self.model, self.device, **self.config['data'])
+            self.verbose(msg)
 #         for name, para in self.model.named_parameters():
 #             if para.requires_grad and name not in nonfreeze_keys:
 #                 para.requires_grad = False
@@ -127,22 +144,34 @@ class Solver(BaseSolver):
         hyps=[]
         txts=[]
         ans=[]
+        writer = ResultWriter(self.output_file, ['idx', 'prob', 'truth', 'correct'], self.result_format, self.resume)
+        if len(writer.written) > 0:
+            self.verbose('Resuming test set, {} utterances already done.'.format(len(writer.written)))
+            # Rows already written are returned along with the new ones
+            for row in writer.read():
+                names.append(row[0])
+                hyps.append(row[1])
+                txts.append(row[2])
+                ans.append(row[3])
         for data in self.tt_set:
             name, feat, feat_len, txt = data
+            if name[0] in writer.written:
+                continue
             feat = feat.to(self.device)
             feat_len = feat_len.to(self.device)
             txt = txt.to(self.device)
             
             with torch.no_grad():
-                hyp = self.model(feat, feat_len)
+                hyp = self.classify(feat, feat_len)
             an = ((hyp>=0.5) == (txt==1)).tolist()[0]
-            print(name, ' ', hyp.tolist()[0], ' ', txt.tolist()[0], ' ', an)
+            writer.write([[name[0], hyp.tolist()[0], txt.tolist()[0], an]])
             names.append(name[0])
             hyps.append(hyp.tolist()[0])
             txts.append(txt.tolist()[0])
-            ans.append(((hyp>=0.5) == (txt==1)).tolist()[0])
+            ans.append(an)
             
             
+        writer.close()
         self.verbose('All done !')
         return names, hyps, txts, ans
 
@@ -158,7 +187,7 @@ class Solver(BaseSolver):
 
             # Forward model
             with torch.no_grad():
-                output = self.model(feat, feat_len)
+                output = self.classify(feat, feat_len)
 
             loss = self.bceloss(output, txt)
 
@@ -10,6 +10,7 @@ from core.hubert import Hubert_Classifier
 from core.optim import Optimizer
 from core.data import load_hubert_dataset
 from core.util import human_format, cal_er, feat_to_fig
+from core.result import ResultWriter
 from transformers import (
     Wav2Vec2FeatureExtractor,
     HubertModel,
@@ -25,11 +26,18 @@ class Solver(BaseSolver):
         self.best_wer = {'att': 3.0, 'ctc': 3.0}
         # Curriculum learning affects data loader
         self.curriculum = self.config['hparas']['curriculum']
-        model_path="TencentGameMate/chinese-hubert-large"
-        self.hubert = HubertModel.from_pretrained(model_path)
-        self.hubert = self.hubert.to(self.device)
-#         self.hubert = self.hubert.half()
-        self.hubert.eval()
+        # Test output (tsv as .csv, or parquet), partially written outputs are resumed w/ --resume
+        self.result_format = getattr(self.paras, 'result_format', 'tsv')
+        self.resume = getattr(self.paras, 'resume', False)
+        self.output_file = str(self.ckpdir) + '_output' + ('.parquet' if self.result_format == 'parquet' else '.csv')
+        # Frozen HuBERT is not needed if its outputs are read from the embedding store
+        self.embedding_cache = self.config['data'].get('embedding_cache')
+        if self.embedding_cache is None:
+            model_path="TencentGameMate/chinese-hubert-large"
+            self.hubert = HubertModel.from_pretrained(model_path)
+            self.hubert = self.hubert.to(self.device)
+#             self.hubert = self.hubert.half()
+            self.hubert.eval()
         
 #     def load_my_state_dict(self, state_dict):
  
@@ -89,6 +97,14 @@ class Solver(BaseSolver):
 
         return feat, feat_len, txt, txt_len
 
+    def hidden_state(self, feat):
+        ''' HuBERT last_hidden_state of a batch (or the stored embedding of it) '''
+        if self.embedding_cache is not None:
+            # Stored [B x D] as a single-step last_hidden_state
+            return feat.unsqueeze(1)
+        with torch.no_grad():
+            return self.hubert(feat[0]).last_hidden_state
+
     def load_data(self):
         print("Load data for training/validation, store tokenizer and input/output shape")
         self.dv_set, self.tt_set = \
@@ -136,24 +152,35 @@ class Solver(BaseSolver):
         hyps=[]
         txts=[]
         ans=[]
+        writer = ResultWriter(self.output_file, ['idx', 'prob', 'truth', 'correct'], self.result_format, self.resume)
+        if len(writer.written) > 0:
+            self.verbose('Resuming test set, {} utterances already done.'.format(len(writer.written)))
+            # Rows already written are returned along with the new ones
+            for row in writer.read():
+                names.append(row[0])
+                hyps.append(row[1])
+                txts.append(row[2])
+                ans.append(row[3])
         for data in self.tt_set:
             name, feat, feat_len, txt = data
+            if name[0] in writer.written:
+                continue
             feat = feat.to(self.device)
             feat_len = feat_len.to(self.device)
             txt = txt.to(self.device)
             
             with torch.no_grad():
-                outputs = self.hubert(feat[0])
-                last_hidden_state = outputs.last_hidden_state
+                last_hidden_state = self.hidden_state(feat)
                 hyp = self.model(last_hidden_state)
             an = ((hyp>=0.5) == (txt==1)).tolist()[0]
-            print(name, ' ', hyp.tolist()[0], ' ', txt.tolist()[0], ' ', an)
+            writer.write([[name[0], hyp.tolist()[0], txt.tolist()[0], an]])
             names.append(name[0])
             hyps.append(hyp.tolist()[0])
             txts.append(txt.tolist()[0])
-            ans.append(((hyp>=0.5) == (txt==1)).tolist()[0])
+            ans.append(an)
             
             
+        writer.close()
         self.verbose('All done !')
         return names, hyps, txts, ans
 
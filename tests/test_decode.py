@@ -0,0 +1,45 @@
+#! python
+# -*- coding: utf-8 -*-
+# Author: kun
+# @Time: 2019-10-29 20:45
+
+import pytest
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from core.asr import ASR
+from core.decode import BeamDecoder
+
+VOCAB_SIZE = 30
+FEAT_DIM = 40
+# Lengths are multiples of encoder downsampling rate s.t. packed encoder output doesn't depend on padding
+LENGTHS = [40, 88, 24, 64]
+
+
+def make_asr(module='LSTM', num_head=1):
+    torch.manual_seed(0)
+    asr = ASR(FEAT_DIM, VOCAB_SIZE, 0.3,
+              encoder=dict(vgg=False, module=module, bidirection=True, dim=[32, 32], dropout=[0, 0],
+                           layer_norm=[False, False], proj=[True, True], sample_rate=[1, 2],
+                           sample_style='drop', pack=True),
+              attention=dict(mode='loc', dim=16, num_head=num_head, v_proj=False, temperature=1,
+                             loc_kernel_size=3, loc_kernel_num=4),
+              decoder=dict(module=module, dim=32, layer=1, dropout=0))
+    # Rarely emit <eos> s.t. most hypotheses end by max. length
+    with torch.no_grad():
+        asr.decoder.char_trans.bias[1] -= 5.0
+    return asr.eval()
+
+
+@pytest.mark.parametrize('module,num_head', [('LSTM', 1), ('GRU', 1), ('LSTM', 2)])
+def test_unsorted_batch_matches_single_utterance(module, num_head):
+    asr = make_asr(module, num_head)
+    decoder = BeamDecoder(asr, None, beam_size=3, min_len_ratio=0, max_len_ratio=0.2, ctc_weight=0.3)
+    torch.manual_seed(1)
+    feats = [torch.randn(n, FEAT_DIM) for n in LENGTHS]
+    with torch.no_grad():
+        batch = decoder(pad_sequence(feats, batch_first=True), torch.LongTensor(LENGTHS))
+        for feat, hyps in zip(feats, batch):
+            single = decoder(feat.unsqueeze(0), torch.LongTensor([len(feat)]))[0]
+            assert [seq for seq, _ in hyps] == [seq for seq, _ in single]
+            assert [score for _, score in hyps] == pytest.approx([score for _, score in single], abs=1e-4)
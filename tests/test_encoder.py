@@ -0,0 +1,31 @@
+#! python
+# -*- coding: utf-8 -*-
+# Author: kun
+# @Time: 2019-10-29 20:45
+
+import pytest
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from core.asr import Encoder
+
+FEAT_DIM = 40
+
+
+@pytest.mark.parametrize('vgg,module,sample_style', [
+    (False, 'LSTM', 'drop'), (False, 'GRU', 'concat'), (True, 'LSTM', 'drop'), (True, 'GRU', 'concat')])
+def test_packed_encoder_matches_single_utterance(vgg, module, sample_style):
+    torch.manual_seed(0)
+    encoder = Encoder(FEAT_DIM, vgg=vgg, module=module, bidirection=True, dim=[16, 16], dropout=[0, 0],
+                      layer_norm=[False, True], proj=[sample_style == 'drop'] * 2, sample_rate=[1, 2],
+                      sample_style=sample_style, pack=True).eval()
+    # Lengths w/ remainders of VGG & RNN downsampling
+    lengths = [53, 101, 38, 77]
+    feats = [torch.randn(n, FEAT_DIM) for n in lengths]
+    with torch.no_grad():
+        output, output_len = encoder(pad_sequence(feats, batch_first=True), torch.LongTensor(lengths))
+        for i, feat in enumerate(feats):
+            single, single_len = encoder(feat.unsqueeze(0), torch.LongTensor([len(feat)]))
+            assert int(output_len[i]) == int(single_len[0])
+            assert torch.allclose(output[i, :output_len[i]], single[0, :single_len[0]], atol=1e-5)
+            assert (output[i, output_len[i]:] == 0).all()
@@ -8,7 +8,8 @@ from core.solver import BaseSolver
 
 from core.asr import ASR, Encoder_Classifier
 from core.optim import Optimizer
-from core.data import load_biclass_dataset
+from core.data import load_biclass_dataset, load_encoder_cache
+from core.embedding import cached_nonfreeze_keys
 from core.util import human_format, cal_er, feat_to_fig
 
 
@@ -22,6 +23,8 @@ class Solver(BaseSolver):
         self.bestloss=100
         # Curriculum learning affects data loader
         self.curriculum = self.config['hparas']['curriculum']
+        # Train/test fc alone on stored output of the frozen encoder
+        self.encoder_cache = self.config['data'].get('encoder_cache')
         
 #     def load_my_state_dict(self, state_dict):
  
@@ -81,6 +84,12 @@ class Solver(BaseSolver):
 
         return feat, feat_len, txt, txt_len
 
+    def classify(self, feat, feat_len):
+        ''' Model output, feat is the stored encoder output if encoder cache is enabled '''
+        if self.encoder_cache is not None:
+            return self.model.head(feat[0])
+        return self.model(feat, feat_len)
+
     def load_data(self):
         print("Load data for training/validation, store tokenizer and input/output shape")
         self.tr_set, self.dv_set, self.feat_dim, msg = \
@@ -115,10 +124,21 @@ class Solver(BaseSolver):
         for name, para in self.model.named_parameters():
             if para.requires_grad and name not in nonfreeze_keys:
                 para.requires_grad = False
+        if self.encoder_cache is not None:
+            # Stored encoder output is only valid if the encoder stays frozen
+            nonfreeze_keys = cached_nonfreeze_keys(
+                [name for name, para in self.model.named_parameters() if para.requires_grad])
+            for name, para in self.model.named_parameters():
+                para.requires_grad = name in nonfreeze_keys
         for name, para in self.model.named_parameters():
             if para.requires_grad:print(name)
         non_frozen_parameters = [p for p in self.model.parameters() if p.requires_grad]
         self.optimizer = Optimizer(non_frozen_parameters, **self.config['hparas'])
+        if self.encoder_cache is not None:
+            # Same datasets as load_data(), batches of stored encoder output
+            self.tr_set, self.dv_set, msg = \
+                load_encoder_cache(self.tr_set, self.dv_set, self.model, self.device, **self.config['data'])
+            self.verbose(msg)
 
         # ToDo: other training methods
 
@@ -152,7 +172,7 @@ class Solver(BaseSolver):
 
                 # Forward model
                 # Note: txt should NOT start w/ <sos>
-                output = self.model(feat, feat_len)
+                output = self.classify(feat, feat_len)
 #                 print(output.shape)
 #                 print(output)
 #                 print('txt:',txt)
@@ -210,7 +230,7 @@ class Solver(BaseSolver):
 
             # Forward model
             with torch.no_grad():
-                output = self.model(feat, feat_len)
+                output = self.classify(feat, feat_len)
 
             loss = self.bceloss(output, txt)
             valid_loss+=loss
@@ -26,11 +26,14 @@ class Solver(BaseSolver):
         self.bestloss=100
         # Curriculum learning affects data loader
         self.curriculum = self.config['hparas']['curriculum']
-        model_path="TencentGameMate/chinese-hubert-large"
-        self.hubert = HubertModel.from_pretrained(model_path)
-        self.hubert = self.hubert.to(self.device)
-#         self.hubert = self.hubert.half()
-        self.hubert.eval()
+        # Frozen HuBERT is not needed if its outputs are read from the embedding store
+        self.embedding_cache = self.config['data'].get('embedding_cache')
+        if self.embedding_cache is None:
+            model_path="TencentGameMate/chinese-hubert-large"
+            self.hubert = HubertModel.from_pretrained(model_path)
+            self.hubert = self.hubert.to(self.device)
+#             self.hubert = self.hubert.half()
+            self.hubert.eval()
 
         
 #     def load_my_state_dict(self, state_dict):
@@ -91,6 +94,14 @@ class Solver(BaseSolver):
 
         return feat, feat_len, txt, txt_len
 
+    def hidden_state(self, feat):
+        ''' HuBERT last_hidden_state of a batch (or the stored embedding of it) '''
+        if self.embedding_cache is not None:
+            # Stored [B x D] as a single-step last_hidden_state
+            return feat.unsqueeze(1)
+        with torch.no_grad():
+            return self.hubert(feat[0]).last_hidden_state
+
     def load_data(self):
         print("Load data for training/validation, store tokenizer and input/output shape")
         self.tr_set, self.dv_set= \
@@ -163,9 +174,7 @@ class Solver(BaseSolver):
 
                 # Forward model
                 # Note: txt should NOT start w/ <sos>
-                with torch.no_grad():
-                    outputs = self.hubert(feat[0])
-                    last_hidden_state = outputs.last_hidden_state
+                last_hidden_state = self.hidden_state(feat)
                 output = self.model(last_hidden_state)
 #                 print(output.shape)
 #                 print(output)
@@ -225,8 +234,7 @@ class Solver(BaseSolver):
 #             with torch.no_grad():
 #                 output = self.model(feat)
             with torch.no_grad():
-                outputs = self.hubert(feat[0])
-                last_hidden_state = outputs.last_hidden_state
+                last_hidden_state = self.hidden_state(feat)
 #                 print('last_hidden_state',last_hidden_state)
 #                 print(torch.isnan(last_hidden_state).any())
 #                 print(last_hidden_state.shape)
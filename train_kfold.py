@@ -0,0 +1,204 @@
+#! python
+# -*- coding: utf-8 -*-
+# Author: kun
+# @Time: 2019-10-29 20:36
+
+import os
+import math
+import torch
+import torch.multiprocessing as mp
+from core.solver import BaseSolver
+
+from core.asr import Encoder_Classifier, Encoder_CDR
+from core.optim import Optimizer
+from core.audio import FeatureTable
+from core.data import load_kfold_dataset, create_fold_loader
+from core.embedding import EmbeddingStore, EncoderEmbedding, encoder_signature, cached_nonfreeze_keys, \
+    CACHED_NONFREEZE_KEYS
+from core.option import default_hparas
+from core.util import human_format
+
+# Parameters trained on top of the ASR encoder (same as train_binaryclass2_5folds.py / train_CDR_5folds.py)
+NONFREEZE_KEYS = {
+    'vag': ['fc.weight', 'fc.bias', 'encoder.layers.4.layer.weight_ih_l0_reverse',
+            'encoder.layers.4.layer.weight_hh_l0_reverse', 'encoder.layers.4.layer.bias_ih_l0_reverse',
+            'encoder.layers.4.layer.bias_hh_l0_reverse'],
+    'vagcdr': ['fc.weight', 'fc.bias', 'encoder.layers.0.extractor.0.weight', 'encoder.layers.0.extractor.0.bias',
+               'encoder.layers.4.layer.weight_ih_l0_reverse', 'encoder.layers.4.layer.weight_hh_l0_reverse',
+               'encoder.layers.4.layer.bias_ih_l0_reverse', 'encoder.layers.4.layer.bias_hh_l0_reverse']
+}
+
+
+def build_model(task, feat_dim, model_config):
+    if task == 'vagcdr':
+        return Encoder_CDR(feat_dim, **model_config)
+    return Encoder_Classifier(feat_dim, **model_config)
+
+
+def train_fold(k, fold, task, config, dataset, fold_index, features, base_state, feat_dim, device, ckpdir,
+               seed=0, n_jobs=0, pin_memory=False, n_threads=None):
+    ''' Train on all folds but k from base_state, then evaluate on fold k.
+        Module-level so it can run in a worker process, features/base_state are shared, not copied. '''
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    torch.manual_seed(seed)
+    cached = isinstance(features, EmbeddingStore)
+    tr_index = [i for j, index in enumerate(fold_index) if j != k for i in index]
+    ascending = config['hparas']['curriculum'] > 0
+    tr_set = create_fold_loader(dataset, tr_index, features, 'train', ascending, n_jobs, pin_memory,
+                                **config['data']['corpus'])
+    tt_set = create_fold_loader(dataset, fold_index[k], features, 'test', ascending, n_jobs, pin_memory,
+                                **config['data']['corpus'])
+
+    # Model starts from the same pre-trained state in every fold
+    model = build_model(task, feat_dim, config['model']).to(device)
+    model.load_state_dict(base_state, strict=False)
+    nonfreeze_keys = CACHED_NONFREEZE_KEYS if cached else NONFREEZE_KEYS[task]
+    for name, para in model.named_parameters():
+        para.requires_grad = name in nonfreeze_keys
+    optimizer = Optimizer([p for p in model.parameters() if p.requires_grad], **config['hparas'])
+    criterion = torch.nn.MSELoss() if task == 'vagcdr' else torch.nn.BCELoss()
+
+    def classify(feat, feat_len):
+        if cached:
+            return model.head(feat[0])
+        return model(feat, feat_len)
+
+    # Train
+    step = 0
+    max_step = config['hparas']['max_step']
+    model.train()
+    while step < max_step:
+        total_loss = 0
+        for _, feat, feat_len, txt in tr_set:
+            optimizer.pre_step(step)
+            loss = criterion(classify(feat.to(device), feat_len.to(device)), txt.to(device))
+            loss.backward()
+            grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), default_hparas['GRAD_CLIP'])
+            if math.isnan(grad_norm):
+                print('[Fold {}] Error : grad norm is NaN @ step {}'.format(fold, step))
+            else:
+                optimizer.step()
+            total_loss += loss.item()
+            step += 1
+            if step >= max_step:
+                break
+        print('[Fold {}] step {} | Tr loss = {:.4f}'.format(fold, human_format(step), total_loss / len(tr_set)))
+
+    os.makedirs(ckpdir, exist_ok=True)
+    torch.save({"model": model.state_dict(), "optimizer": optimizer.get_opt_state_dict(), "global_step": step,
+                "loss": total_loss / len(tr_set)}, os.path.join(ckpdir, 'latest.pth'))
+
+    # Evaluate on held-out fold
+    model.eval()
+    names, hyps, txts = [], [], []
+    tt_loss = 0
+    with torch.no_grad():
+        for name, feat, feat_len, txt in tt_set:
+            hyp = classify(feat.to(device), feat_len.to(device))
+            tt_loss += criterion(hyp, txt.to(device)).item()
+            names.append(name[0])
+            hyps.append(hyp.tolist()[0])
+            txts.append(txt.tolist()[0])
+    result = {'fold': fold, 'names': names, 'hyps': hyps, 'txts': txts, 'loss': tt_loss / len(tt_set)}
+    if task == 'vagcdr':
+        result['rmse'] = math.sqrt(sum((h - t) ** 2 for h, t in zip(hyps, txts)) / len(hyps))
+    else:
+        result['acc'] = sum((h >= 0.5) == (t == 1) for h, t in zip(hyps, txts)) / len(hyps)
+    return result
+
+
+class Solver(BaseSolver):
+    ''' Solver for k-fold cross validation of classifier/CDR on top of the ASR encoder.
+        Dataset, features and the pre-trained checkpoint are loaded once and shared by all folds. '''
+
+    def __init__(self, config, paras, mode):
+        super().__init__(config, paras, mode)
+        self.task = self.config['data']['corpus']['name'].lower()
+        self.folds = self.config['data']['corpus']['folds']
+        # Train fc alone on stored output of the frozen encoder
+        self.encoder_cache = self.config['data'].get('encoder_cache')
+        # Num. of folds trained in parallel (0: one fold after another in this process)
+        self.fold_workers = self.config['hparas'].get('fold_workers', 0)
+
+    def load_data(self):
+        print("Load dataset of all folds")
+        self.dataset, self.fold_index, self.audio_transform, self.feat_dim, msg = \
+            load_kfold_dataset(self.config['hparas']['curriculum'] > 0, self.config['data']['corpus'],
+                               self.config['data']['audio'])
+        self.verbose(msg)
+
+    def set_model(self):
+        print("Load pre-trained model once for all folds")
+        self.model = build_model(self.task, self.feat_dim, self.config['model'])
+        self.verbose(self.model.create_msg())
+        if not self.paras.load:
+            raise ValueError('Cross validation starts from a pre-trained ASR checkpoint, specify it w/ --load.')
+        ckpt = torch.load(self.paras.load, map_location='cpu')
+        ckpt = ckpt.get('model', ckpt)
+        self.base_state = {k: v for k, v in ckpt.items() if k in self.model.state_dict()}
+        self.verbose('Load {} tensors of pre-trained model from {}'.format(len(self.base_state), self.paras.load))
+        self.model.load_state_dict(self.base_state, strict=False)
+
+        if self.encoder_cache is not None:
+            # Encoder is frozen, its output is computed once and shared by all folds
+            cached_nonfreeze_keys(NONFREEZE_KEYS[self.task])
+            self.model = self.model.to(self.device)
+            self.features = EmbeddingStore(self.encoder_cache,
+                                           encoder_signature(self.model, self.config['data']['audio']),
+                                           self.model.encoder.out_dim)
+            file_list = [str(f) for f in self.dataset.file_list]
+            if len(self.features.missing(file_list)) > 0:
+                self.features.fill(file_list, EncoderEmbedding(self.model, self.audio_transform, self.device))
+            self.verbose('Encoder cache = {}'.format(self.features.store_dir))
+        else:
+            # Features of all utterances are extracted once and shared by all folds
+            self.features = FeatureTable(self.audio_transform, self.dataset.file_list)
+            self.verbose('Feature table = {}'.format(self.features.extra_repr()))
+        del self.model
+
+    def exec(self):
+        print("Cross validation over {} folds".format(len(self.folds)))
+        jobs = [dict(k=k, fold=fold, task=self.task, config=self.config, dataset=self.dataset,
+                     fold_index=self.fold_index, features=self.features, base_state=self.base_state,
+                     feat_dim=self.feat_dim, device=self.device, ckpdir=os.path.join(self.ckpdir, fold),
+                     seed=self.paras.seed)
+                for k, fold in enumerate(self.folds)]
+        if self.fold_workers > 0:
+            # Tensors are moved to shared memory once instead of being copied to every worker
+            if isinstance(self.features, FeatureTable):
+                self.features.share_memory()
+            for v in self.base_state.values():
+                v.share_memory_()
+            # Pool workers are daemonic and can't start DataLoader workers, n_jobs stays 0
+            n_threads = max(1, torch.get_num_threads() // self.fold_workers)
+            for job in jobs:
+                job['n_threads'] = n_threads
+            ctx = mp.get_context('spawn')
+            with ctx.Pool(self.fold_workers) as pool:
+                results = pool.starmap(_run_fold, [(job,) for job in jobs])
+        else:
+            results = [train_fold(n_jobs=self.paras.njobs, pin_memory=self.paras.pin_memory, **job) for job in jobs]
+
+        # Aggregated metrics
+        metric = 'rmse' if self.task == 'vagcdr' else 'acc'
+        for r in results:
+            self.verbose('Fold {} | Test loss = {:.4f} | {} = {:.4f} | Number of utts = {}'.format(
+                r['fold'], r['loss'], metric, r[metric], len(r['names'])))
+            self.write_log('kfold', {r['fold'] + '_' + metric: r[metric]})
+        scores = torch.tensor([r[metric] for r in results], dtype=torch.double)
+        losses = torch.tensor([r['loss'] for r in results], dtype=torch.double)
+        hyps = [h for r in results for h in r['hyps']]
+        txts = [t for r in results for t in r['txts']]
+        if metric == 'rmse':
+            pooled = math.sqrt(sum((h - t) ** 2 for h, t in zip(hyps, txts)) / len(hyps))
+        else:
+            pooled = sum((h >= 0.5) == (t == 1) for h, t in zip(hyps, txts)) / len(hyps)
+        self.verbose('{} folds | Test loss = {:.4f} +- {:.4f} | {} = {:.4f} +- {:.4f} | pooled {} = {:.4f}'.format(
+            len(results), losses.mean(), losses.std(), metric, scores.mean(), scores.std(), metric, pooled))
+        self.log.close()
+        return results
+
+
+def _run_fold(job):
+    return train_fold(**job)